@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: cache.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: none
+Description:
+    A local cache of KnowledgeBases loaded from mongodb
+"""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+
+import pymongo
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def cache_key(collection, query, projection):
+    """ Return the canonical hash of a load from the collection
+
+    :collection: the collection queried
+    :query: the query of the load
+    :projection: the projection of the load
+    :returns: a hex digest
+
+    """
+    canonical = json.dumps([collection.full_name, query, projection],
+                           sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def collection_stamp(collection):
+    """ Return the max _id and created_at of the collection, which change
+        when check-ins are added.
+
+        Each field is read by a sorted find_one, which needs an index on
+        created_at to avoid scanning the collection, so KnowledgeBaseCache
+        reads the stamp once per collection (ref: KnowledgeBaseCache.stamp).
+    """
+    stamp = list()
+    for field in ['_id', 'created_at']:
+        doc = collection.find_one({}, {field: 1},
+                                  sort=[(field, pymongo.DESCENDING)])
+        stamp.append(str(doc.get(field)) if doc else None)
+    return stamp
+
+
+def _nbytes(checkins):
+    """ Return the estimated number of bytes of the check-ins in memory,
+        including the strings in object columns
+    """
+    try:
+        return int(checkins.memory_usage(index=True, deep=True).sum())
+    except TypeError:  # pandas < 0.17 has no deep introspection
+        size = int(checkins.memory_usage(index=True).sum())
+        for col in checkins.columns:
+            if checkins[col].dtype == object:
+                size += sum(sys.getsizeof(v) for v in checkins[col].values)
+        return size
+
+
+class KnowledgeBaseCache(object):
+
+    """ Keeping recently loaded KnowledgeBases in memory with LRU eviction
+        under a byte budget. If spill_dir is given, the evicted entries and
+        those left in memory at close are written to Parquet snapshots on
+        disk, so they are loaded from the disk instead of mongodb later in
+        the run and in the next runs.
+
+        Each entry is stamped with the max _id and created_at of the
+        collection when loaded and is invalidated once they change. The
+        stamp of a collection is read once for the lifetime of the cache,
+        i.e., one run, so check-ins added during a run are picked up by the
+        next run.
+    """
+
+    def __init__(self, budget=1 << 30, spill_dir=None):
+        """ Initialize an empty cache
+
+        :budget: the number of bytes of check-ins kept in memory
+        :spill_dir: the directory for the entries on disk (None means the
+            evicted entries are dropped)
+
+        """
+        super(KnowledgeBaseCache, self).__init__()
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self._entries = OrderedDict()
+        self._size = 0
+        self._stamps = dict()
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stamp(self, collection):
+        """ Return the collection_stamp of the collection, which is read
+            from mongodb only the first time
+        """
+        if collection.full_name not in self._stamps:
+            self._stamps[collection.full_name] = collection_stamp(collection)
+        return self._stamps[collection.full_name]
+
+    def _spillPath(self, key):
+        """ Return the paths of the snapshot and its stamp
+        """
+        path = os.path.join(self.spill_dir, key)
+        return path + '.parquet', path + '.json'
+
+    def _spill(self, key, stamp, kbase, compact):
+        """ Store the entry on disk
+        """
+        if self.spill_dir is None:
+            return
+        snapshot, meta = self._spillPath(key)
+        kbase.toParquet(snapshot)
+        with open(meta, 'w') as fout:
+            json.dump({'stamp': stamp, 'compact': compact}, fout)
+        _LOGGER.info('Spilled %s', key)
+
+    def _unspill(self, key, stamp):
+        """ Return (KnowledgeBase, compact) of the entry on disk if it is
+            still valid or otherwise None
+        """
+        from expertise.ger import KnowledgeBase
+        if self.spill_dir is None:
+            return None
+        snapshot, meta = self._spillPath(key)
+        if not os.path.exists(meta):
+            return None
+        with open(meta) as fin:
+            info = json.load(fin)
+        if info['stamp'] != stamp:
+            os.remove(meta)
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+            return None
+        return (KnowledgeBase.fromParquet(snapshot, compact=info['compact']),
+                info['compact'])
+
+    def _evict(self):
+        """ Move the least recently used entries to the disk until the
+            entries in memory fit in the budget
+        """
+        while self._size > self.budget and self._entries:
+            key, (stamp, kbase, compact, size, spilled) = \
+                self._entries.popitem(last=False)
+            self._size -= size
+            if not spilled:
+                self._spill(key, stamp, kbase, compact)
+
+    def put(self, key, stamp, kbase, compact=False, spilled=False):
+        """ Add a KnowledgeBase to the cache
+
+        :key: the cache_key of the load
+        :stamp: the collection_stamp when loading
+        :kbase: the KnowledgeBase loaded
+        :compact: whether the KnowledgeBase is compact
+        :spilled: whether the entry is already on the disk
+
+        """
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[3]
+        size = _nbytes(kbase.checkins)
+        self._entries[key] = (stamp, kbase, compact, size, spilled)
+        self._size += size
+        self._evict()
+
+    def close(self):
+        """ Write the entries in memory to the disk, so the next run starts
+            with them
+        """
+        for key, entry in self._entries.items():
+            if not entry[4]:
+                self._spill(key, *entry[:3])
+                self._entries[key] = entry[:4] + (True, )
+
+    def get(self, key, stamp):
+        """ Return the cached KnowledgeBase of the load or None if it is not
+            cached or has been invalidated
+
+        :key: the cache_key of the load
+        :stamp: the current collection_stamp
+        :returns: a KnowledgeBase or None
+
+        """
+        if key in self._entries:
+            entry = self._entries.pop(key)
+            if entry[0] == stamp:
+                self._entries[key] = entry
+                return entry[1]
+            self._size -= entry[3]
+            return None
+        entry = self._unspill(key, stamp)
+        if entry is None:
+            return None
+        self.put(key, stamp, entry[0], entry[1], spilled=True)
+        return entry[0]
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: checkpoint.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: none
+Description:
+    A manifest of the ranking lists written to an output file so that an
+    interrupted run can be resumed
+"""
+
+import os
+import json
+import logging
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+
+    """ Recording the units (topic_id, rank_method, profile_type) written to
+        an output file together with the size of the file after each unit.
+
+        On resuming, the output is truncated to the size after the last
+        recorded unit, which drops any unit partly written, and the run
+        appends the units not recorded yet.
+    """
+
+    def __init__(self, manifest):
+        """ Load the manifest if it exists
+
+        :manifest: the path to the manifest in JSON lines
+
+        """
+        super(Checkpoint, self).__init__()
+        self.manifest = manifest
+        self.done = set()
+        self.offset = 0
+        self._fout = None
+        if not os.path.exists(manifest):
+            return
+        entries = list()
+        broken = False
+        with open(manifest) as fin:
+            for line in fin:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # The last line was cut by the interruption
+                    broken = True
+                    break
+        if broken:
+            self._rewrite(entries)
+        for entry in entries:
+            self.done.add(tuple(entry['unit']))
+            self.offset = entry['offset']
+
+    def _rewrite(self, entries):
+        """ Rewrite the manifest with the entries
+        """
+        with open(self.manifest, 'w') as fout:
+            for entry in entries:
+                fout.write(json.dumps(entry) + '\n')
+
+    def __contains__(self, unit):
+        return tuple(unit) in self.done
+
+    def resume(self, output):
+        """ Truncate the output to the last recorded unit
+
+        :output: the path to the output
+        :returns: whether to append to the output (False means the output
+            should be written from the beginning)
+
+        """
+        if self.offset <= 0 or not os.path.exists(output):
+            self.reset()
+            return False
+        if os.path.getsize(output) < self.offset:
+            _LOGGER.warning('%s is shorter than recorded, starting over.',
+                            output)
+            self.reset()
+            return False
+        with open(output, 'r+') as fout:
+            fout.truncate(self.offset)
+        _LOGGER.info('Resuming with %d units done', len(self.done))
+        return True
+
+    def reset(self):
+        """ Forget all the units recorded
+        """
+        self.done = set()
+        self.offset = 0
+        self.close()
+        if os.path.exists(self.manifest):
+            os.remove(self.manifest)
+
+    def record(self, unit, offset):
+        """ Record a unit written to the output
+
+        :unit: (topic_id, rank_method, profile_type)
+        :offset: the size of the output after the unit is written
+
+        """
+        if self._fout is None:
+            self._fout = open(self.manifest, 'a')
+        self._fout.write(json.dumps({'unit': list(unit),
+                                     'offset': offset}) + '\n')
+        self._fout.flush()
+        os.fsync(self._fout.fileno())
+        self.done.add(tuple(unit))
+        self.offset = offset
+
+    def close(self):
+        """ Close the manifest
+        """
+        if self._fout is not None:
+            self._fout.close()
+            self._fout = None
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: expertindex.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: none
+Description:
+    A persistent index of the top experts precomputed for every topic in
+    every region, so that rankExperts is answered without loading check-ins
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+import logging
+import threading
+
+
+_LOGGER = logging.getLogger(__name__)
+
+# The columns of the topics indexed and their fields in formatted queries
+TOPIC_FIELDS = [('pid', 'place.id'),
+                ('cid', 'place.category.id'),
+                ('zcid', 'place.category.zero_category')]
+
+
+def topic_key(region_name, topic_value):
+    """ Return the canonical key of a topic in a region
+
+    :region_name: the name of the region ref: REGIONS
+    :topic_value: the Mongo query of the topic, e.g., {'place.id': ...},
+        where the values are compared as text so that the ids read as
+        numpy or Python numbers and as strings give the same key
+    :returns: a string
+
+    """
+    topic_value = dict((path, unicode(value))
+                       for path, value in topic_value.iteritems())
+    return json.dumps([region_name, topic_value], sort_keys=True)
+
+
+def _method_name(method):
+    """ Return the name of a metrics or profile type
+    """
+    return getattr(method, '__name__', method)
+
+
+def _rows(region_name, topic_value, rank_method, profile_type, rank, scores):
+    """ Return the rows of a ranking list in the index
+    """
+    key = topic_key(region_name, topic_value)
+    rank_method = _method_name(rank_method)
+    profile_type = _method_name(profile_type)
+    return [(region_name, key, rank_method, profile_type, i + 1, r, float(s))
+            for i, (r, s) in enumerate(zip(rank, scores))]
+
+
+class ExpertIndex(object):
+
+    """ The top candidates and their scores of every topic for each metrics
+        and profile type stored in SQLite.
+
+        Only the first depth candidates are stored, so a lookup with a longer
+        cutoff is a miss unless the whole ranking list is shorter. The index
+        is stamped with the state of the check-ins it was built from and
+        refresh rebuilds it once the check-ins change.
+
+        The database is kept in WAL mode, so the services looking up the
+        index keep reading the old ranking lists while another process
+        rebuilds a region.
+    """
+
+    def __init__(self, filename, depth=100):
+        """ Open or create the index
+
+        :filename: the path to the SQLite database (':memory:' for testing)
+        :depth: the number of candidates stored per ranking list of a new
+            index (an existing index keeps the depth it was built with)
+
+        """
+        super(ExpertIndex, self).__init__()
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        if filename != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS ranking ('
+                'region TEXT, topic TEXT, rank_method TEXT, '
+                'profile_type TEXT, rank INTEGER, candidate TEXT, '
+                'score REAL, '
+                'PRIMARY KEY (topic, rank_method, profile_type, rank))')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'key TEXT PRIMARY KEY, value TEXT)')
+        self.depth = self.getMeta('depth', depth)
+
+    def close(self):
+        """ Close the database
+        """
+        self._conn.close()
+
+    def getMeta(self, key, default=None):
+        """ Return the value of a meta entry
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?',
+                                     (key, )).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def setMeta(self, key, value):
+        """ Set the value of a meta entry
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (key, json.dumps(value)))
+
+    @property
+    def stamp(self):
+        """ The stamp of the check-ins which the index is built from
+        """
+        return self.getMeta('stamp')
+
+    def lookup(self, query, rank_method, profile_type, cutoff=5):
+        """ Return the ranking list stored for the query
+
+        :query: a dict() object holding topic and region for query
+            {topic:{name:, value:}, region:{name:, value:} }
+        :rank_method: the ranking method
+        :profile_type: the ranking profile type
+        :cutoff: the length of the returned list (<= 0 means all)
+        :returns: (users in rank, score) or None if the ranking list is not
+            in the index or the index cannot be read at the moment
+
+        """
+        key = topic_key(query['region']['name'], query['topic']['value'])
+        try:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT candidate, score FROM ranking '
+                    'WHERE topic = ? AND rank_method = ? AND profile_type = ? '
+                    'ORDER BY rank',
+                    (key, _method_name(rank_method),
+                     _method_name(profile_type))).fetchall()
+        except sqlite3.OperationalError:
+            _LOGGER.warning('Failed at looking up %s', key, exc_info=True)
+            return None
+        if len(rows) == 0:
+            return None
+        if len(rows) >= self.depth and not 0 < cutoff <= self.depth:
+            return None  # The list may be truncated
+        if cutoff > 0:
+            rows = rows[:cutoff]
+        return [r[0] for r in rows], [r[1] for r in rows]
+
+    def store(self, region_name, topic_value, rank_method, profile_type,
+              rank, scores):
+        """ Store a ranking list, replacing the stored one
+
+        :region_name: the name of the region ref: REGIONS
+        :topic_value: the Mongo query of the topic
+        :rank_method: the ranking method
+        :profile_type: the ranking profile type
+        :rank: the candidates in rank
+        :scores: the scores of the candidates
+
+        """
+        rows = _rows(region_name, topic_value, rank_method, profile_type,
+                     rank, scores)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM ranking WHERE topic = ? AND rank_method = ? '
+                'AND profile_type = ?',
+                (topic_key(region_name, topic_value),
+                 _method_name(rank_method), _method_name(profile_type)))
+            self._conn.executemany(
+                'INSERT INTO ranking VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def replaceRegion(self, region_name, rows):
+        """ Replace all ranking lists of the region in one transaction, so
+            that lookups never see a region partly built
+        """
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM ranking WHERE region = ?',
+                               (region_name, ))
+            self._conn.executemany(
+                'INSERT INTO ranking VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def buildRegion(self, region_name, rkbase, metrics, profile_types):
+        """ Rank every topic in a region and replace the ranking lists of the
+            region in one transaction, where the rows are written topic by
+            topic instead of being kept for the whole region
+
+        :region_name: the name of the region ref: REGIONS
+        :rkbase: the KnowledgeBase of all check-ins in the region
+        :metrics: a list of metrics
+        :profile_types: a list of profile types
+        :returns: the number of topics indexed
+
+        """
+        from expertise.ger import KnowledgeBase
+        count = 0
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM ranking WHERE region = ?',
+                               (region_name, ))
+            for col, path in TOPIC_FIELDS:
+                if col not in rkbase.checkins:
+                    continue
+                for value, checkins in rkbase.checkins.groupby(col):
+                    if len(checkins) == 0:
+                        continue
+                    kbase = KnowledgeBase(checkins)
+                    rows = list()
+                    for mtc in metrics:
+                        for pf_type in profile_types:
+                            try:
+                                rank, scores = kbase.rank(pf_type, mtc,
+                                                          cutoff=self.depth)
+                            except ValueError:
+                                _LOGGER.exception('Failed at %s=%s', path,
+                                                  value)
+                                continue
+                            rows.extend(_rows(region_name, {path: value},
+                                              mtc, pf_type, rank, scores))
+                    self._conn.executemany(
+                        'INSERT INTO ranking VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        rows)
+                    count += 1
+        _LOGGER.info('Indexed %d topics in %s', count, region_name)
+        return count
+
+    def build(self, retrieval, metrics=None, profile_types=None,
+              regions=None):
+        """ Build the index from all check-ins of the regions
+
+        :retrieval: the GeoExpertRetrieval loading the check-ins
+        :metrics: a list of metrics (default: INDEX_METRICS)
+        :profile_types: a list of profile types (default: PROFILE_TYPES)
+        :regions: a dict of regions in the form of REGIONS (default: REGIONS)
+
+        """
+        from expertise import ger
+        metrics = metrics or ger.INDEX_METRICS
+        profile_types = profile_types or ger.PROFILE_TYPES
+        regions = regions or ger.REGIONS
+        stamp = source_stamp(retrieval)
+        for region_name in sorted(regions.iterkeys()):
+            _LOGGER.info('Loading %s...', region_name)
+            try:
+                rkbase = retrieval.fetchRegion(regions[region_name])
+            except ValueError:
+                _LOGGER.exception('Failed at loading %s', region_name)
+                self.replaceRegion(region_name, list())
+                continue
+            self.buildRegion(region_name, rkbase, metrics, profile_types)
+        self.setMeta('depth', self.depth)
+        self.setMeta('stamp', stamp)
+
+    def refresh(self, retrieval, force=False, **kargs):
+        """ Rebuild the index if the check-ins have changed since the index
+            was built
+
+        :retrieval: the GeoExpertRetrieval loading the check-ins
+        :force: whether to rebuild the index anyway
+        :returns: whether the index is rebuilt
+
+        """
+        if not force and self.stamp == source_stamp(retrieval):
+            _LOGGER.info('The index is up to date.')
+            return False
+        self.build(retrieval, **kargs)
+        return True
+
+
+def source_stamp(retrieval):
+    """ Return the stamp of the check-ins of a GeoExpertRetrieval, i.e., the
+        collection_stamp or the modification time of the snapshot
+    """
+    from expertise.cache import collection_stamp
+    if retrieval.snapshot is not None:
+        return [os.path.getmtime(retrieval.snapshot)]
+    return collection_stamp(retrieval.collection)
+
+
+def console():
+    """ An interface for building and refreshing the index
+    """
+    import pymongo
+    from expertise.ger import GeoExpertRetrieval
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+
+    parser = argparse.ArgumentParser(
+        description='Precomputing the top experts of every topic in every '
+        'region for answering rankExperts from the index')
+    parser.add_argument(
+        'action', choices=['build', 'refresh'],
+        help='build the index or rebuild it only if the check-ins changed')
+    parser.add_argument(
+        'index', metavar='INDEX',
+        help='The SQLite file of the index')
+    parser.add_argument(
+        '-d', '--db', dest='db', action='store',
+        metavar='DB', default='geoexpert',
+        help='The name of the db instance in mongodb')
+    parser.add_argument(
+        '-c', '--collection', dest='collection', action='store',
+        metavar='COLLECTION', default='checkin',
+        help='The collection containing the check-in profile of condidates')
+    parser.add_argument(
+        '-s', '--snapshot', dest='snapshot', action='store',
+        metavar='FILE', default=None,
+        help='A Parquet snapshot of check-ins used instead of mongodb')
+    parser.add_argument(
+        '-n', '--depth', dest='depth', action='store',
+        metavar='N', default=100, type=int,
+        help='The number of candidates stored per ranking list')
+    args = parser.parse_args()
+    collection = None
+    if args.snapshot is None:
+        collection = pymongo.MongoClient()[args.db][args.collection]
+    retrieval = GeoExpertRetrieval('index', collection, args.snapshot,
+                                   compact=True)
+    index = ExpertIndex(args.index, args.depth)
+    if args.action == 'build':
+        index.depth = args.depth
+        index.build(retrieval)
+    else:
+        index.refresh(retrieval)
+    index.close()
+
+
+if __name__ == '__main__':
+    console()
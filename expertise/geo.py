@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: geo.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: none
+Description:
+    Assigning coordinates to regions of bounding boxes or (multi)polygons
+    with a grid index.
+"""
+
+import numpy as np
+
+
+def _rings(geometry):
+    """ Return all rings of a GeoJSON-like Polygon or MultiPolygon
+
+    :geometry: {'type': 'Polygon' | 'MultiPolygon', 'coordinates': ...}
+        where coordinates are in (lng, lat)
+    :returns: a list of arrays of shape (n, 2)
+
+    """
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError('Unsupported geometry %s.' % geometry['type'])
+    return [np.asarray(r, dtype=np.float64) for p in polygons for r in p]
+
+
+def points_in_rings(lats, lons, rings):
+    """ Test whether the points are inside the rings by the even-odd rule,
+        so that holes and multiple polygons are handled alike.
+
+    :lats: an array of latitudes
+    :lons: an array of longitudes
+    :rings: a list of arrays of (lng, lat) vertices
+    :returns: an array of bool
+
+    """
+    inside = np.zeros(len(lats), dtype=bool)
+    for ring in rings:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        for i in range(len(ring)):
+            if y1[i] == y2[i]:
+                continue
+            crossing = ((y1[i] > lats) != (y2[i] > lats)) & \
+                (lons < (x2[i] - x1[i]) * (lats - y1[i]) /
+                 (y2[i] - y1[i]) + x1[i])
+            inside ^= crossing
+    return inside
+
+
+class RegionIndex(object):
+
+    """ A grid index over regions for labelling many coordinates at once.
+
+        Each region has a bounding box (south, north, west, east) and an
+        optional geometry. Points are tested strictly inside the bounding box
+        and, if a geometry is given, inside the geometry as well. Only the
+        regions overlapping the grid cell of a point are tested.
+    """
+
+    def __init__(self, names, bboxes, geometries=None, cell=0.1):
+        """ Build the index
+
+        :names: the names of the regions
+        :bboxes: a list of (south, north, west, east)
+        :geometries: a list of GeoJSON-like geometries or None for each region
+        :cell: the size of the grid cells in degrees
+
+        """
+        super(RegionIndex, self).__init__()
+        self.names = np.asarray(list(names) + [None], dtype=object)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        geometries = geometries or [None] * len(self.bboxes)
+        self.rings = [_rings(g) if g is not None else None
+                      for g in geometries]
+        self.cell = cell
+        self._cells = dict()
+        for r, (south, north, west, east) in enumerate(self.bboxes):
+            for cx in range(self._cellOf(west), self._cellOf(east) + 1):
+                for cy in range(self._cellOf(south), self._cellOf(north) + 1):
+                    self._cells.setdefault((cx, cy), list()).append(r)
+
+    def _cellOf(self, degree):
+        """ Return the grid coordinate of the degree
+        """
+        return int(np.floor(degree / self.cell))
+
+    def assign(self, lats, lons):
+        """ Return the index of the region of each point or -1 if the point
+            is not in any region. The first region in the order of the index
+            is taken if regions overlap.
+
+        :lats: an array of latitudes
+        :lons: an array of longitudes
+        :returns: an array of region indices
+
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = np.empty(len(lats), dtype=np.int64)
+        result.fill(-1)
+        if len(lats) == 0:
+            return result
+        cx = np.floor(lons / self.cell).astype(np.int64)
+        cy = np.floor(lats / self.cell).astype(np.int64)
+        cells, inverse = np.unique(
+            np.vstack([cx, cy]).T.copy().view([('x', np.int64),
+                                               ('y', np.int64)]).ravel(),
+            return_inverse=True)
+        candidates = [self._cells.get((c['x'], c['y']), []) for c in cells]
+        depth = max(len(c) for c in candidates)
+        if depth == 0:
+            return result
+        table = np.empty((len(cells), depth), dtype=np.int64)
+        table.fill(-1)
+        for i, c in enumerate(candidates):
+            table[i, :len(c)] = c
+        for k in range(depth):
+            region = table[inverse, k]
+            pending = np.flatnonzero((region >= 0) & (result < 0))
+            if len(pending) == 0:
+                continue
+            region = region[pending]
+            south, north, west, east = self.bboxes[region].T
+            plat, plon = lats[pending], lons[pending]
+            hit = (south < plat) & (plat < north) & \
+                (west < plon) & (plon < east)
+            for r in np.unique(region[hit]):
+                if self.rings[r] is None:
+                    continue
+                sel = hit & (region == r)
+                hit[sel] = points_in_rings(plat[sel], plon[sel],
+                                           self.rings[r])
+            result[pending[hit]] = region[hit]
+        return result
+
+    def assignNames(self, lats, lons):
+        """ Return the name of the region of each point or None
+
+        :lats: an array of latitudes
+        :lons: an array of longitudes
+        :returns: an array of names
+
+        """
+        return self.names[self.assign(lats, lons)]
+
+
+def geometry_bbox(geometry):
+    """ Return the (south, north, west, east) bounding the geometry
+    """
+    points = np.vstack(_rings(geometry))
+    return (points[:, 1].min(), points[:, 1].max(),
+            points[:, 0].min(), points[:, 0].max())
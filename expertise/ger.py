@@ -12,10 +12,25 @@ Description:
 import sys
 import argparse
 import logging
+import threading
+import multiprocessing
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
 import numpy as np
 import pandas as pd
 import pymongo
+from scipy import sparse
 import expertise.pandasmongo as pandasmongo
+from expertise import profiling
+from expertise.cache import KnowledgeBaseCache
+from expertise.cache import cache_key
+from expertise.checkpoint import Checkpoint
+from expertise.geo import RegionIndex
+from expertise.geo import geometry_bbox
+from expertise.visits import VisitAggregate
+from expertise.visits import VisitProfile
 
 CKLAT = 'place.bounding_box.coordinates.0.0.1'
 CKLON = 'place.bounding_box.coordinates.0.0.0'
@@ -43,18 +58,166 @@ REGIONS = {
 }
 
 
+def make_region(name, geometry):
+    """ Make a region of a polygon or multipolygon for REGIONS where the
+        value is the bounding box used for querying the check-ins.
+
+    :name: the name of the region
+    :geometry: a GeoJSON-like Polygon or MultiPolygon in (lng, lat)
+    :returns: the region {name:, value:, geometry:}
+
+    """
+    south, north, west, east = geometry_bbox(geometry)
+    return {'name': name,
+            'value': {CKLAT: {'$gt': south, '$lt': north},
+                      CKLON: {'$gt': west, '$lt': east}},
+            'geometry': geometry}
+
+
+_REGION_INDEX = dict()
+
+
+def region_index(regions=None, cell=0.1):
+    """ Return a RegionIndex over the regions, where the index of REGIONS is
+        built once and rebuilt only when regions are added or removed
+
+    :regions: a dict of regions in the form of REGIONS (default: REGIONS)
+    :cell: the size of the grid cells in degrees
+    :returns: a RegionIndex
+
+    """
+    if regions is None:
+        key = (tuple(sorted(REGIONS.iterkeys())), cell)
+        if key not in _REGION_INDEX:
+            _REGION_INDEX.clear()
+            _REGION_INDEX[key] = region_index(REGIONS, cell)
+        return _REGION_INDEX[key]
+    names = sorted(regions.iterkeys())
+    bboxes = [(regions[n]['value'][CKLAT]['$gt'],
+               regions[n]['value'][CKLAT]['$lt'],
+               regions[n]['value'][CKLON]['$gt'],
+               regions[n]['value'][CKLON]['$lt']) for n in names]
+    geometries = [regions[n].get('geometry') for n in names]
+    return RegionIndex([regions[n]['name'] for n in names],
+                       bboxes, geometries, cell=cell)
+
+
+def assign_regions(lats, lons, regions=None):
+    """ Return the names of the regions of the coordinates or None for
+        those not in any region
+
+    :lats: an array of latitudes
+    :lons: an array of longitudes
+    :regions: a dict of regions in the form of REGIONS (default: REGIONS)
+    :returns: an array of region names
+
+    """
+    return region_index(regions).assignNames(lats, lons)
+
+
 def get_region(lat, lon):
     """ return the name of the region of the given coordinates
 
-    :lat: @todo
-    :lon: @todo
-    :returns: @todo
+    :lat: the latitude
+    :lon: the longitude
+    :returns: the name of the region or None
 
     """
-    for v in REGIONS.itervalues():
-        if ((v['value'][CKLAT]['$gt'] < lat < v['value'][CKLAT]['$lt']) and
-                v['value'][CKLON]['$lt'] < lon < v['value'][CKLON]['$gt']):
-            return v['name']
+    return assign_regions([lat], [lon])[0]
+
+
+def _add_created_date(checkins):
+    """ Add the column of created_date which is the created_at at the
+        beginning of the day, by flooring the datetime64 to days
+    """
+    with profiling.stage('created_date', rows=len(checkins)):
+        checkins['created_date'] = np.asarray(
+            checkins['created_at'].values, dtype='datetime64[ns]')\
+            .astype('datetime64[D]').astype('datetime64[ns]')
+
+
+_FILTER_OPS = {'$gt': '>',
+               '$gte': '>=',
+               '$lt': '<',
+               '$lte': '<=',
+               '$ne': '!=',
+               '$in': 'in'}
+
+
+def _query2filters(query, projection):
+    """ Translate a Mongo query into filters on the projected columns, which
+        are checked against the statistics of Parquet row groups
+
+    :query: a Mongo query of dot paths to values or to {operator: value}
+    :projection: the projection from dot paths to columns
+    :returns: a list of (column, op, value)
+
+    """
+    filters = list()
+    for path, cond in query.iteritems():
+        if path not in projection:
+            raise ValueError('Field %s is not in the projection.' % path)
+        if isinstance(cond, dict):
+            for op, val in cond.iteritems():
+                if op not in _FILTER_OPS:
+                    raise ValueError('Unsupported operator %s.' % op)
+                filters.append((projection[path], _FILTER_OPS[op], val))
+        else:
+            filters.append((projection[path], '=', cond))
+    return filters
+
+
+_STAT_OPS = {'=': lambda lo, hi, v: lo <= v <= hi,
+             '>': lambda lo, hi, v: hi > v,
+             '>=': lambda lo, hi, v: hi >= v,
+             '<': lambda lo, hi, v: lo < v,
+             '<=': lambda lo, hi, v: lo <= v,
+             '!=': lambda lo, hi, v: not lo == hi == v,
+             'in': lambda lo, hi, vs: any(lo <= v <= hi for v in vs)}
+
+
+def _stat_value(value):
+    """ Return the min or max of a column chunk comparable to the values in
+        queries, i.e., the strings decoded as unicode
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _may_match(row_group, columns, filters):
+    """ Return whether the check-ins in a Parquet row group may match the
+        filters according to the min and max of its column chunks, where a
+        column chunk without statistics or with values incomparable to the
+        filter may match
+
+    :row_group: the RowGroupMetaData
+    :columns: a dict from the column names to their positions
+    :filters: a list of (column, op, value) ref: _query2filters
+    :returns: a bool
+
+    """
+    for col, op, val in filters:
+        if col not in columns:
+            continue
+        stats = row_group.column(columns[col]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        try:
+            if not _STAT_OPS[op](_stat_value(stats.min),
+                                 _stat_value(stats.max), val):
+                return False
+        except (TypeError, ValueError):
+            continue
+    return True
+
+
+_QUERY_OPS = {'$gt': np.greater,
+              '$gte': np.greater_equal,
+              '$lt': np.less,
+              '$lte': np.less_equal,
+              '$ne': np.not_equal,
+              '$in': np.in1d}
 
 
 class KnowledgeBase(object):
@@ -80,18 +243,59 @@ class KnowledgeBase(object):
         """
         super(KnowledgeBase, self).__init__()
         self.checkins = checkins
+        self._aggregate = None
+
+    TSV_COLUMNS = ['user', 'category', 'created_at', 'pid']
+
+    TSV_DTYPES = {'id': np.int64,
+                  'uid': np.int64,
+                  'lat': np.float64,
+                  'lng': np.float64}
 
     @classmethod
-    def fromTSV(cls, filename):
-        """ docstring for fromFile
+    def fromTSV(cls,
+                filename,
+                names=None,
+                sep='\t',
+                date_format='%Y-%m-%d %H:%M:%S',
+                chunksize=1 << 20,
+                compact=True):
+        """ Constructing the knowledgebase from a TSV/CSV file of check-ins
+            without a header
+
+            The file is read in chunks with explicit dtypes (TSV_DTYPES and
+            strings for the others) and timestamps of a fixed format. Each
+            chunk is made compact before reading the next one. Check-ins are
+            numbered as their ids if there is no id column.
+            :param filename: the path to the file
+            :param names: the columns in the file (default: TSV_COLUMNS)
+            :param sep: the separator of the columns
+            :param date_format: the strftime format of created_at (None means
+                inferring the format)
+            :param chunksize: the number of check-ins read at a time
+            :param compact: whether to make the KnowledgeBase compact
+            :return: a KnowledgeBase instance containing the check-ins
         """
-        checkins = pd.read_csv(
-            filename,
-            sep='\t',
-            header=None,
-            names=['user', 'category', 'created_at', 'pid'],
-            parse_dates=[2])
-        return cls(checkins)
+        names = names or KnowledgeBase.TSV_COLUMNS
+        dtype = dict((n, KnowledgeBase.TSV_DTYPES.get(n, object))
+                     for n in names if n != 'created_at')
+        reader = pd.read_csv(filename, sep=sep, header=None, names=names,
+                             dtype=dtype, engine='c', chunksize=chunksize)
+        dictionaries = dict() if compact else None
+        kbases = list()
+        offset = 0
+        for checkins in reader:
+            checkins['created_at'] = pd.to_datetime(checkins['created_at'],
+                                                    format=date_format)
+            if 'id' not in checkins:
+                checkins['id'] = np.arange(offset, offset + len(checkins))
+            offset += len(checkins)
+            _add_created_date(checkins)
+            kbase = cls(checkins)
+            kbases.append(kbase.compact(dictionaries) if compact else kbase)
+        if len(kbases) <= 0:
+            raise ValueError('No data in %s.' % (filename, ))
+        return cls.concat(kbases, dictionaries)
 
     DEFAULT_PROJECTION = {'id': 'id',
                           'user.screen_name': 'user',
@@ -106,11 +310,22 @@ class KnowledgeBase(object):
                           'place.category.zero_category': 'zcid',
                           'created_at': 'created_at'}
 
+    DEFAULT_DTYPES = {'id': np.int64,
+                      'uid': np.int64,
+                      'lat': np.float64,
+                      'lng': np.float64,
+                      'created_at': 'datetime64[ns]'}
+
     @classmethod
     def fromMongo(cls,
                   collection,
                   query=None,
-                  projection=None):
+                  projection=None,
+                  compact=False,
+                  batch_size=None,
+                  chunksize=None,
+                  partitions=None,
+                  cache=None):
         """ Constructing the knowledgebase from a set of check-ins
             queryed against the given collection in a MongoDB instance
             :param collection: the collection instance where the check-ins
@@ -119,14 +334,243 @@ class KnowledgeBase(object):
                 certain criteria
             :param projection: the final fields that should include in the
                 queried
+            :param compact: whether to make the KnowledgeBase compact
+            :param batch_size: the number of documents in each batch returned
+                by Mongo
+            :param chunksize: the number of check-ins flattened at a time,
+                where each chunk is made compact before loading the next one
+                (None means loading all at once)
+            :param partitions: the number of _id ranges read concurrently
+                (None means reading with a single cursor)
+            :param cache: a KnowledgeBaseCache to look up before querying
+                and to keep the loaded KnowledgeBase
+            :return: a KnowledgeBase instance containing the check-ins
+        """
+        projection = projection or KnowledgeBase.DEFAULT_PROJECTION
+        query = query or dict()
+        if cache is not None:
+            key = cache_key(collection, query, projection) + \
+                ('-compact' if compact else '')
+            stamp = cache.stamp(collection)
+            kbase = cache.get(key, stamp)
+            if kbase is None:
+                kbase = cls.fromMongo(collection, query, projection,
+                                      compact=compact, batch_size=batch_size,
+                                      chunksize=chunksize,
+                                      partitions=partitions)
+                cache.put(key, stamp, kbase, compact)
+            return kbase
+        if chunksize:
+            dictionaries = dict() if compact else None
+            kbases = list()
+            for checkins in pandasmongo.iterDataFrame(
+                    collection, query, projection, chunksize=chunksize,
+                    batch_size=batch_size,
+                    dtypes=KnowledgeBase.DEFAULT_DTYPES):
+                _add_created_date(checkins)
+                kbase = cls(checkins)
+                kbases.append(kbase.compact(dictionaries) if compact
+                              else kbase)
+            if len(kbases) <= 0:
+                raise ValueError('No data returned from the query.')
+            return cls.concat(kbases, dictionaries)
+        if partitions and partitions > 1:
+            checkins = pandasmongo.getDataFrameParallel(
+                collection, query, projection, partitions=partitions,
+                batch_size=batch_size, dtypes=KnowledgeBase.DEFAULT_DTYPES)
+        else:
+            checkins = pandasmongo.getDataFrame(
+                collection, query, projection, batch_size=batch_size,
+                dtypes=KnowledgeBase.DEFAULT_DTYPES)
+        _add_created_date(checkins)
+        kbase = cls(checkins)
+        return kbase.compact() if compact else kbase
+
+    COMPACT_COLUMNS = ['user', 'pid', 'place', 'category', 'cid',
+                       'z_category', 'zcid']
+
+    def compact(self, dictionaries=None):
+        """ Store the check-ins compactly where the columns of strings
+            (COMPACT_COLUMNS) become categorical codes and created_date
+            becomes created_day, the int32 number of days since epoch.
+            Ranking works on the codes and only decodes the users in the
+            returned lists.
+
+            :param dictionaries: a dict from column names to sorted Index of
+                values shared by KnowledgeBases, which is extended by the new
+                values of this KnowledgeBase
+            :return: the KnowledgeBase itself
+        """
+        dictionaries = dictionaries if dictionaries is not None else dict()
+        for col in KnowledgeBase.COMPACT_COLUMNS:
+            if col not in self.checkins or hasattr(self.checkins[col], 'cat'):
+                continue
+            values = self.checkins[col]
+            uniques = values.dropna().unique()
+            if col in dictionaries:
+                uniques = np.union1d(dictionaries[col].values, uniques)
+            else:
+                uniques = np.unique(uniques)
+            dictionaries[col] = pd.Index(uniques)
+            self.checkins[col] = pd.Categorical(values,
+                                                categories=dictionaries[col])
+        if 'created_date' in self.checkins:
+            self.checkins['created_day'] = \
+                self.checkins['created_date'].values.astype('datetime64[D]')\
+                .astype(np.int32)
+            del self.checkins['created_date']
+        self._aggregate = None
+        return self
+
+    @classmethod
+    def concat(cls, kbases, dictionaries=None):
+        """ Concatenate the check-ins of KnowledgeBases at once
+
+            :param kbases: a list of KnowledgeBases
+            :param dictionaries: the dictionaries shared by the compact
+                KnowledgeBases, to which all categorical columns are recoded
+            :return: a KnowledgeBase instance containing all the check-ins
+        """
+        frames = [kb.checkins for kb in kbases]
+        if dictionaries:
+            frames = [f.copy() for f in frames]
+            for f in frames:
+                for col, cats in dictionaries.iteritems():
+                    if col not in f:
+                        continue
+                    mapping = cats.get_indexer(f[col].cat.categories)
+                    codes = f[col].cat.codes.values
+                    f[col] = pd.Categorical.from_codes(
+                        np.where(codes >= 0, mapping[codes], -1), cats)
+        return cls(pd.concat(frames, ignore_index=True))
+
+    VISIT_PROJECTION = {'user.screen_name': 'user',
+                        'place.id': 'pid',
+                        'created_at': 'created_at'}
+
+    @staticmethod
+    def aggregateMongo(collection, query=None, projection=None,
+                       chunksize=pandasmongo.CHUNKSIZE, batch_size=None):
+        """ Return the VisitAggregate of the check-ins queried against the
+            collection, which is built chunk by chunk so that check-ins
+            which do not fit in memory can still be ranked.
+            :param collection: the collection instance where the check-ins
+                stored
+            :param query: a query to fetch a set of check-in that meets
+                certain criteria
+            :param projection: the projection for user, pid and created_at
+            :param chunksize: the number of check-ins in a chunk
+            :param batch_size: the number of documents in each batch returned
+                by Mongo
+            :return: a VisitAggregate
+        """
+        projection = projection or KnowledgeBase.VISIT_PROJECTION
+        return VisitAggregate.fromChunks(pandasmongo.iterDataFrame(
+            collection, query or dict(), projection, chunksize=chunksize,
+            batch_size=batch_size, dtypes=KnowledgeBase.DEFAULT_DTYPES))
+
+    def toParquet(self, filename, row_group_size=65536):
+        """ Store the check-ins as a columnar snapshot in Parquet
+
+            The check-ins are sorted by topics so that the statistics of each
+            row group let fromParquet skip row groups of other topics.
+            :param filename: the path to the snapshot
+            :param row_group_size: the number of check-ins in a row group
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        columns = [c for c in KnowledgeBase.DEFAULT_PROJECTION.itervalues()
+                   if c in self.checkins]
+        keys = [c for c in ['zcid', 'cid', 'pid', 'created_at']
+                if c in self.checkins]
+        checkins = self.checkins[columns]
+        if keys:
+            # The last key is the primary one in lexsort
+            order = np.lexsort([np.asarray(checkins[k], dtype=object)
+                                for k in reversed(keys)])
+            checkins = checkins.iloc[order]
+        table = pa.Table.from_pandas(checkins, preserve_index=False)
+        pq.write_table(table, filename, row_group_size=row_group_size)
+
+    @classmethod
+    def fromParquet(cls, filename, query=None, projection=None,
+                    compact=False):
+        """ Constructing the knowledgebase from a Parquet snapshot of
+            check-ins (ref: toParquet)
+            :param filename: the path to the snapshot
+            :param query: a query in the same form as for fromMongo, where
+                only the row groups whose statistics may match it are read
+            :param projection: the projection used for making the snapshot
+            :param compact: whether to make the KnowledgeBase compact
             :return: a KnowledgeBase instance containing the check-ins
         """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
         projection = projection or KnowledgeBase.DEFAULT_PROJECTION
         query = query or dict()
-        checkins = pandasmongo.getDataFrame(collection, query, projection)
-        checkins['created_date'] = checkins['created_at'].apply(
-            lambda x: x.replace(hour=0, minute=0, second=0, microsecond=0))
-        return cls(checkins)
+        filters = _query2filters(query, projection)
+        snapshot = pq.ParquetFile(filename)
+        metadata = snapshot.metadata
+        groups = [metadata.row_group(i)
+                  for i in range(metadata.num_row_groups)]
+        columns = dict((groups[0].column(j).path_in_schema, j)
+                       for j in range(groups[0].num_columns)) \
+            if groups else dict()
+        tables = [snapshot.read_row_group(i, use_pandas_metadata=True)
+                  for i, group in enumerate(groups)
+                  if _may_match(group, columns, filters)]
+        if len(tables) <= 0:
+            raise ValueError('No data returned from the query.')
+        checkins = pa.concat_tables(tables).to_pandas()
+        if len(checkins) <= 0:
+            raise ValueError('No data returned from the query.')
+        _add_created_date(checkins)
+        kbase = cls(checkins)
+        if query:
+            # Row groups are only pruned by their statistics
+            kbase = kbase.select(query, projection)
+        return kbase.compact() if compact else kbase
+
+    def select(self, query, projection=None):
+        """ Return a KnowledgeBase of the check-ins matching the query without
+            a round trip to the database
+            :param query: a query in the same form as for fromMongo, where
+                the fields are dot paths in the projection
+            :param projection: the projection used for loading the check-ins
+            :return: a KnowledgeBase instance containing the check-ins
+        """
+        projection = projection or KnowledgeBase.DEFAULT_PROJECTION
+        mask = np.ones(len(self.checkins), dtype=bool)
+        for path, cond in query.iteritems():
+            if path not in projection:
+                raise ValueError('Field %s is not in the projection.' % path)
+            col = self.checkins[projection[path]]
+            if hasattr(col, 'cat') and not isinstance(cond, dict):
+                # Comparing the codes without decoding the column
+                cats = col.cat.categories
+                code = cats.get_loc(cond) if cond in cats else -2
+                mask &= (col.cat.codes.values == code)
+                continue
+            vals = np.asarray(col.values)
+            if isinstance(cond, dict):
+                for op, val in cond.iteritems():
+                    if op not in _QUERY_OPS:
+                        raise ValueError('Unsupported operator %s.' % op)
+                    mask &= _QUERY_OPS[op](vals, val)
+            else:
+                mask &= (vals == cond)
+        if not mask.any():
+            raise ValueError('No data returned from the query.')
+        return KnowledgeBase(self.checkins[mask])
+
+    @property
+    def aggregate(self):
+        """ The VisitAggregate of the check-ins shared by all rankings
+        """
+        if self._aggregate is None:
+            with profiling.stage('aggregate', rows=len(self.checkins)):
+                self._aggregate = VisitAggregate(self.checkins)
+        return self._aggregate
 
     def rank(self, profile_type, metrics, cutoff=5):
         """Rank the userbase based on the given profile_type and metrics
@@ -137,14 +581,20 @@ class KnowledgeBase(object):
         :returns: @todo
 
         """
-        return profile_type(self.checkins, metrics, cutoff=cutoff)
+        return profile_type(self.aggregate, metrics, cutoff=cutoff)
 
 
 def rankCheckinProfile(checkins, metrics, **kargs):
     """ Rank the profile based on checkins
+
+        :checkins: a DataFrame of check-ins or a VisitAggregate of them
     """
-    profiles = checkins.groupby('user')
-    rank, scores = metrics(profiles, **kargs)
+    with profiling.stage('profile', profile_type='rankCheckinProfile'):
+        profile = VisitAggregate.of(checkins).checkin
+    with profiling.stage('metric', metric=metrics.__name__,
+                         profile_type='rankCheckinProfile',
+                         rows=len(profile)):
+        rank, scores = metrics(profile, **kargs)
     return rank, scores
 
 
@@ -152,29 +602,78 @@ def rankActiveDayProfile(checkins, metrics, **kargs):
     """ Rank the profiles based on active days
 
         All check-ins on the same day are considered as only one check-in
+        :checkins: a DataFrame of check-ins or a VisitAggregate of them
     """
-    checkins.sort('created_at', ascending=True, inplace=True)
-    day_profiles = checkins.drop_duplicates(
-        cols=['user',
-              'created_date',
-              'pid'],
-        take_last=True
-    )
-    day_profiles['created_at'] = day_profiles['created_date']
-    profiles = day_profiles.groupby('user')
-    rank, scores = metrics(profiles, **kargs)
+    with profiling.stage('profile', profile_type='rankActiveDayProfile'):
+        profile = VisitAggregate.of(checkins).activeday
+    with profiling.stage('metric', metric=metrics.__name__,
+                         profile_type='rankActiveDayProfile',
+                         rows=len(profile)):
+        rank, scores = metrics(profile, **kargs)
     return rank, scores
 
 
+def _as_profile(profiles):
+    """ Return a VisitProfile for profiles which are either a VisitProfile or
+        check-ins grouped by users.
+    """
+    if isinstance(profiles, VisitProfile):
+        return profiles
+    return VisitProfile.fromGroupBy(profiles)
+
+
+def _topk(scores, cutoff):
+    """ Return the positions of the cutoff largest scores in descending order
+        where ties are broken by the positions.
+
+    :scores: an array of scores
+    :cutoff: the number of positions to return (<= 0 means all)
+    :returns: an array of positions
+
+    """
+    n = len(scores)
+    if 0 < cutoff < n:
+        # Partial selection of the cutoff-th largest score, then only the
+        # candidates reaching it are sorted
+        kth = np.partition(scores, n - cutoff)[n - cutoff]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(n)
+    order = np.lexsort((candidates, -scores[candidates]))
+    if cutoff > 0:
+        order = order[:cutoff]
+    return candidates[order]
+
+
+def _ranked(profile, scores, cutoff):
+    """ Return (users in rank, score) of the users in the profile
+
+    :profile: the VisitProfile of the users
+    :scores: the scores aligned with profile.users
+    :cutoff: the cutoff of the length of the returned list
+    :returns: (users in rank, score)
+
+    """
+    scores = np.asarray(scores)
+    top = _topk(scores, cutoff)
+    return profile.users[top], scores[top]
+
+
+def _ranked_series(scores, cutoff):
+    """ Return (users in rank, score) from a Series of scores indexed by users
+        where ties are broken by the sorted users
+    """
+    scores = scores.sort_index()
+    top = _topk(scores.values, cutoff)
+    return scores.index.values[top], scores.values[top]
+
+
 def naive_metrics(profiles, cutoff=-1, **_):
     """ using number of visitings / active days themselves for ranking
         score_u = N_ck(u, p)
     """
-    mrank = profiles['id'].count().order(ascending=False)
-    if cutoff > 0:
-        return mrank.index.values[:cutoff], mrank.values[:cutoff]
-    else:
-        return mrank.index.values, mrank.values
+    profile = _as_profile(profiles)
+    return _ranked(profile, profile.totals, cutoff)
 
 
 def random_metrics(profiles, cutoff=-1, **_):
@@ -186,12 +685,12 @@ def random_metrics(profiles, cutoff=-1, **_):
     :returns: @todo
 
     """
-    mrank = profiles['id'].count().index.values.copy()
-    np.random.shuffle(mrank)
+    profile = _as_profile(profiles)
+    # Shuffling the codes so that only the users returned are decoded
+    top = np.random.permutation(len(profile.users))
     if cutoff > 0:
-        return mrank[:cutoff], np.zeros(len(mrank))
-    else:
-        return mrank, np.zeros(len(mrank))
+        top = top[:cutoff]
+    return profile.users[top], np.zeros(len(top))
 
 
 def _time_diff(t_array, t):
@@ -206,27 +705,22 @@ def recency_metrics(profiles, cutoff=-1, **kargs):
     """
     refdate = kargs.get('refdate', REFDATE_DEFAULT)
     decay_rate = kargs.get('decay_rate', DECAYRATE_DEFAULT)
-    mrank = profiles['created_at'].agg(
-        lambda x: np.sum(np.exp(_time_diff(x.values, refdate) * decay_rate))) \
-        .order(ascending=False)
-    if cutoff > 0:
-        return mrank.index.values[:cutoff], mrank.values[:cutoff]
-    else:
-        return mrank.index.values, mrank.values
+    profile = _as_profile(profiles)
+    weights = np.exp(profile.time_diff(refdate, ONEDAY) * decay_rate)
+    if profile.counts is not None:
+        weights = weights * profile.counts
+    scores = np.bincount(profile.ucodes, weights=weights,
+                         minlength=len(profile.users))
+    return _ranked(profile, scores, cutoff)
 
 
 def diversity_metrics(profiles, cutoff=-1, **_):
     """ A metrics boosting diverse visits
         score_{u} = sum_{p in T} log_2 N_{ck}(u, p) + 1
     """
-    mrank = profiles.apply(
-        lambda x: np.sum(np.log2(x.groupby('pid').apply(len) + 1)))\
-        .order(ascending=False)
-
-    if cutoff > 0:
-        return mrank.index.values[:cutoff], mrank.values[:cutoff]
-    else:
-        return mrank.index.values, mrank.values
+    profile = _as_profile(profiles)
+    scores = profile.user_sums(np.log2(profile.pair_counts + 1))
+    return _ranked(profile, scores, cutoff)
 
 
 def RD_metrics(profiles, cutoff=-1, **kargs):
@@ -235,14 +729,12 @@ def RD_metrics(profiles, cutoff=-1, **kargs):
     """
     refdate = kargs.get('refdate', REFDATE_DEFAULT)
     decay_rate = kargs.get('decay_rate', DECAYRATE_DEFAULT)
-    mrank = profiles.apply(
-        lambda x: np.sum(np.log2(x.groupby('pid').apply(
-            lambda x: np.sum(np.exp(_time_diff(x['created_at'].values, refdate) * decay_rate)) + 1
-        )))).order(ascending=False)
-    if cutoff > 0:
-        return mrank.index.values[:cutoff], mrank.values[:cutoff]
-    else:
-        return mrank.index.values, mrank.values
+    profile = _as_profile(profiles)
+    weights = np.exp(profile.time_diff(refdate, ONEDAY) * decay_rate)
+    if profile.counts is not None:
+        weights = weights * profile.counts
+    scores = profile.user_sums(np.log2(profile.pair_sums(weights) + 1))
+    return _ranked(profile, scores, cutoff)
 
 
 def converge(func, init, **kwargs):
@@ -286,64 +778,349 @@ def bao2012_metrics(profiles, cutoff=-1, **_):
     :returns: (users in rank, score)
 
     """
-    visits = profiles.apply(lambda x: x.groupby('pid').apply(lambda x: pd.Series(len(x))))\
-        .reset_index().rename(columns={0: 'cks'})
-    if 'cks' not in visits:
+    profile = _as_profile(profiles)
+    if len(profile) == 0:
         return [], []
+    # prepare the sparse user x poi matrix of visits
+    M = sparse.csr_matrix((profile.pair_counts.astype(np.float64),
+                           (profile.pair_ucodes, profile.pair_pcodes)),
+                          shape=(len(profile.users), len(profile.pids)))
+    MT = M.T.tocsr()
+    logging.debug('M=%s', M)
     # prepare initial values
-    candidates = visits.groupby('user')['cks'].sum()
-    A = candidates.values.astype(np.float64)
+    A = np.asarray(M.sum(axis=1), dtype=np.float64).flatten()
     logging.debug('A=%s', A)
-    M = visits.pivot('user', 'pid', 'cks').fillna(0).values.astype(np.float64)
-    # M = (visits.pivot('user', 'pid', 'cks') > 0).values.astype(np.float64)
-    logging.debug('M=%s', M)
-    # Normalize
-    P = np.dot(M, M.T)
-    # Power Iteration
-    A = converge(lambda x: np.dot(P, x), A, rtol=0.001)
+    # Power Iteration with P = M * M.T applied as M * (M.T * x)
+    A = converge(lambda x: M.dot(MT.dot(x)), A, rtol=0.001)
 
     # Format results
-    mrank = pd.Series(A.flatten(),
-                      index=candidates.index.values).order(ascending=False)
+    return _ranked(profile, A.flatten(), cutoff)
 
-    if cutoff > 0:
-        return mrank.index.values[:cutoff], mrank.values[:cutoff]
-    else:
-        return mrank.index.values, mrank.values
+
+class DecayedScorer(object):
+    """ Keeping the exponentially decayed visits of users so that the scores
+        of recency_metrics and RD_metrics can be refreshed without rescanning
+        all check-ins.
+
+        Since exp d*(t_c - t_ref') = exp d*(t_c - t_ref) * exp -d*(t_ref' -
+        t_ref), moving the refdate forward only rescales the stored sums,
+        and new check-ins are added to them.
+
+        user_sums.....sum_{c} exp d*(t_c - t_ref) per user
+        pair_sums.....sum_{l_c = l} exp d*(t_c - t_ref) per (user, pid)
+    """
+    def __init__(self, refdate=REFDATE_DEFAULT,
+                 decay_rate=DECAYRATE_DEFAULT, activeday=False):
+        """ Initialize an empty scorer
+
+        :refdate: the reference date of the scores
+        :decay_rate: the decay rate d
+        :activeday: whether to score active-day profiles instead of check-in
+            profiles, where the check-ins on the same day should be added
+            in the same batch
+
+        """
+        super(DecayedScorer, self).__init__()
+        self.refdate = np.datetime64(refdate)
+        self.decay_rate = decay_rate
+        self.activeday = activeday
+        self.user_sums = pd.Series([], dtype=np.float64)
+        self.pair_sums = pd.Series([], dtype=np.float64)
+
+    def advance(self, refdate):
+        """ Move the reference date forward and decay the stored sums
+
+        :refdate: the new reference date
+
+        """
+        refdate = np.datetime64(refdate)
+        delta = _time_diff(refdate, self.refdate)
+        if delta < 0:
+            raise ValueError('The refdate can only move forward.')
+        factor = np.exp(-self.decay_rate * delta)
+        self.user_sums *= factor
+        self.pair_sums *= factor
+        self.refdate = refdate
+
+    def add(self, checkins):
+        """ Add new check-ins to the decayed sums
+
+        :checkins: a DataFrame of check-ins or a VisitAggregate of them
+
+        """
+        aggregate = VisitAggregate.of(checkins)
+        profile = aggregate.activeday if self.activeday else aggregate.checkin
+        if len(profile) == 0:
+            return
+        weights = np.exp(profile.time_diff(self.refdate, ONEDAY) *
+                         self.decay_rate)
+        users = pd.Series(np.bincount(profile.ucodes, weights=weights,
+                                      minlength=len(profile.users)),
+                          index=np.asarray(profile.users))
+        pairs = pd.Series(profile.pair_sums(weights),
+                          index=pd.MultiIndex.from_arrays(
+                              [profile.users[profile.pair_ucodes],
+                               profile.pids[profile.pair_pcodes]]))
+        if len(self.pair_sums) == 0:
+            self.user_sums, self.pair_sums = users, pairs
+        else:
+            self.user_sums = self.user_sums.add(users, fill_value=0.)
+            self.pair_sums = self.pair_sums.add(pairs, fill_value=0.)
+
+    def recency(self, cutoff=-1):
+        """ Return (users in rank, score) as recency_metrics at the refdate
+        """
+        return _ranked_series(self.user_sums, cutoff)
+
+    def RD(self, cutoff=-1):
+        """ Return (users in rank, score) as RD_metrics at the refdate
+        """
+        return _ranked_series(
+            np.log2(self.pair_sums + 1).groupby(level=0).sum(), cutoff)
+
+
+def decay_sweep(profiles, decay_rates, refdates):
+    """ Compute the scores of recency_metrics and RD_metrics for every
+        (decay_rate, refdate) setting in one pass over the visits per refdate.
+
+        The visits are weighted by exp d*(t_c - t_ref) against each refdate
+        for all the decay rates at once, so only an R x N array is kept at a
+        time and no factor is split out of the exponent, which would
+        overflow or underflow for large decay rates or refdates far from the
+        visits.
+
+    :profiles: a VisitProfile or check-ins grouped by users
+    :decay_rates: a sequence of R decay rates
+    :refdates: a sequence of K reference dates
+    :returns: (recency, RD) of the scores in arrays of shape (R, K, users)
+
+    """
+    profile = _as_profile(profiles)
+    rates = np.asarray(decay_rates, dtype=np.float64).ravel()
+    nrates, nrefs = len(rates), len(refdates)
+    recency = np.zeros((nrates, nrefs, len(profile.users)))
+    RD = np.zeros((nrates, nrefs, len(profile.users)))
+    if len(profile) == 0:
+        return recency, RD
+    for k, refdate in enumerate(refdates):
+        # R x N weights of the visits
+        weights = np.exp(np.outer(rates, profile.time_diff(
+            np.datetime64(refdate), ONEDAY)))
+        if profile.counts is not None:
+            weights *= profile.counts
+        pair_sums = profile.pair_sums(weights)
+        recency[:, k, :] = profile.user_sums(pair_sums)
+        RD[:, k, :] = profile.user_sums(np.log2(pair_sums + 1))
+    return recency, RD
+
+
+def sweep_name(metrics, decay_rate, refdate):
+    """ Return the name of a metrics with the parameters, e.g.,
+        recency_metrics@d=0.005@ref=2013-08-01T00:00:00Z, which can be
+        used as the rank_method in ranking files for mtrec_eval.
+    """
+    return '%s@d=%g@ref=%s' % (metrics.__name__, decay_rate,
+                               np.datetime64(refdate))
+
+
+def sweep_metrics(profiles, decay_rates, refdates, cutoff=-1):
+    """ Rank the users by recency_metrics and RD_metrics for all the
+        settings of decay rates and refdates
+
+    :profiles: a VisitProfile or check-ins grouped by users
+    :decay_rates: a sequence of decay rates
+    :refdates: a sequence of reference dates
+    :cutoff: the cutoff of the length of each ranking list
+    :returns: a list of (name, users in rank, score) where the name is
+        given by sweep_name
+
+    """
+    profile = _as_profile(profiles)
+    rankings = list()
+    for metrics, scores in zip([recency_metrics, RD_metrics],
+                               decay_sweep(profile, decay_rates, refdates)):
+        for i, decay_rate in enumerate(decay_rates):
+            for k, refdate in enumerate(refdates):
+                rank, score = _ranked(profile, scores[i, k], cutoff)
+                rankings.append((sweep_name(metrics, decay_rate, refdate),
+                                 rank, score))
+    return rankings
 
 
 class GeoExpertRetrieval(object):
     """ A class managing querying the geoexperts.
     """
-    def __init__(self, name, collection):
+    def __init__(self, name, collection, snapshot=None, compact=False,
+                 partitions=None, cache=None, index=None):
+        """ Initialize the retrieval over a collection of check-ins
+
+        :name: the name of the retrieval
+        :collection: the Mongo collection of check-ins
+        :snapshot: a Parquet snapshot of the check-ins used instead of the
+            collection (ref: KnowledgeBase.toParquet)
+        :compact: whether to load the check-ins as compact KnowledgeBases
+        :partitions: the number of concurrent cursors loading check-ins
+        :cache: a KnowledgeBaseCache of the loaded check-ins
+        :index: an ExpertIndex answering rankExperts before loading check-ins
+
+        """
         super(GeoExpertRetrieval, self).__init__()
         self.name = name
         self.collection = collection
+        self.snapshot = snapshot
+        self.compact = compact
+        self.partitions = partitions
+        self.cache = cache
+        self.index = index
         self._logger = logging.getLogger(
             '%s.%s' % (__name__, type(self).__name__))
 
-    def rankExperts(self, query, rank_method, profile_type, cutoff=5):
+    def fetch(self, query):
+        """ Return a KnowledgeBase holding the check-ins for the query
+            :param query: a dict() object holding topic and region for query
+                {topic:{name:, value:}, region:{name:, value:} }
+            :return: a KnowledgeBase instance
+        """
+        q = dict()
+        q.update(query['region']['value'])
+        q.update(query['topic']['value'])
+        return self.load(q)
+
+    def load(self, query):
+        """ Return a KnowledgeBase of the check-ins matching a Mongo query
+            from the snapshot if given or otherwise from the collection
+        """
+        with profiling.stage('fetch') as info:
+            if self.snapshot is not None:
+                kbase = KnowledgeBase.fromParquet(self.snapshot, query,
+                                                  compact=self.compact)
+            else:
+                kbase = KnowledgeBase.fromMongo(self.collection, query,
+                                                compact=self.compact,
+                                                partitions=self.partitions,
+                                                cache=self.cache)
+            info['rows'] = len(kbase.checkins)
+        return kbase
+
+    def fetchRegion(self, region):
+        """ Return a KnowledgeBase holding all check-ins in the region
+            :param region: a dict() object of the region {name:, value:}
+            :return: a KnowledgeBase instance
+        """
+        return self.load(region['value'])
+
+    def aggregateVisits(self, query, activeday=False):
+        """ Return the VisitProfile of the per user x pid visits for the
+            query, which are counted by Mongo with an aggregation pipeline
+            so that only the counts are shipped.
+            :param query: a dict() object holding topic and region for query
+            :param activeday: whether to count the active days instead of
+                check-ins
+            :return: a VisitProfile without visiting times
+        """
+        q = dict()
+        q.update(query['region']['value'])
+        q.update(query['topic']['value'])
+        pipeline = [{'$match': q}]
+        if activeday:
+            pipeline.append({'$group': {'_id': {
+                'user': '$user.screen_name',
+                'pid': '$place.id',
+                'year': {'$year': '$created_at'},
+                'month': {'$month': '$created_at'},
+                'day': {'$dayOfMonth': '$created_at'}}}})
+            pipeline.append({'$group': {
+                '_id': {'user': '$_id.user', 'pid': '$_id.pid'},
+                'cks': {'$sum': 1}}})
+        else:
+            pipeline.append({'$group': {
+                '_id': {'user': '$user.screen_name', 'pid': '$place.id'},
+                'cks': {'$sum': 1}}})
+        result = self.collection.aggregate(pipeline, allowDiskUse=True)
+        if isinstance(result, dict):  # pymongo 2.x
+            result = result['result']
+        visits = pd.DataFrame([(r['_id'].get('user'), r['_id'].get('pid'),
+                                r['cks']) for r in result],
+                              columns=['user', 'pid', 'cks'])
+        visits = visits[visits['user'].notnull() & visits['pid'].notnull()]
+        if len(visits) <= 0:
+            raise ValueError('No data returned from the query.')
+        return VisitProfile.fromPairs(visits['user'], visits['pid'],
+                                      visits['cks'].values)
+
+    def rankExperts(self, query, rank_method, profile_type, cutoff=5,
+                    pushdown=False):
         """ Return a set of parameters for setting up questionnaires
             :param query: a dict() object holding topic and region for query
                 {topic:{name:, value:}, region:{name:, value:} }
             :param rank_method: the ranking method name
             :param profile_type: the ranking profile type
             :param cutoff: the length of the returned list
+            :param pushdown: whether to count the visits in Mongo for the
+                metrics in PUSHDOWN_METRICS instead of fetching check-ins
+            :return: a set of rows containing information for setting up
+                     a set of questions
+        """
+        with profiling.stage('rankExperts', topic_id=query.get('topic_id'),
+                             metric=rank_method.__name__,
+                             profile_type=profile_type.__name__):
+            if self.index is not None:
+                hit = self.index.lookup(query, rank_method, profile_type,
+                                        cutoff)
+                if hit is not None:
+                    return GeoExpertRetrieval.formatRanking(
+                        query, rank_method, profile_type, hit[0], hit[1])
+            if pushdown and self.snapshot is None and \
+                    rank_method in PUSHDOWN_METRICS:
+                profile = self.aggregateVisits(
+                    query, activeday=profile_type is rankActiveDayProfile)
+                rank, scores = rank_method(profile, cutoff=cutoff)
+                return GeoExpertRetrieval.formatRanking(
+                    query, rank_method, profile_type, rank, scores)
+            kbase = self.fetch(query)
+            return self.rankKnowledgeBase(kbase, query, rank_method,
+                                          profile_type, cutoff)
+
+    @staticmethod
+    def rankKnowledgeBase(kbase, query, rank_method, profile_type, cutoff=5):
+        """ Rank the experts in the KnowledgeBase fetched for the query
+            :param kbase: the KnowledgeBase fetched for the query
+            :param query: a dict() object holding topic and region for query
+            :param rank_method: the ranking method name
+            :param profile_type: the ranking profile type
+            :param cutoff: the length of the returned list
             :return: a set of rows containing information for setting up
                      a set of questions
         """
-        q = dict()
-        q.update(query['region']['value'])
-        q.update(query['topic']['value'])
-        kbase = KnowledgeBase.fromMongo(self.collection, q)
         rank, scores = kbase.rank(profile_type, rank_method, cutoff=cutoff)
+        return GeoExpertRetrieval.formatRanking(query, rank_method,
+                                                profile_type, rank, scores)
+
+    @staticmethod
+    def formatRanking(query, rank_method, profile_type, rank, scores):
+        """ Format a ranking list as rows of RANK_SCHEMA
+            :param query: a dict() object holding topic and region for query
+            :param rank_method: the ranking method or its name
+            :param profile_type: the ranking profile type
+            :param rank: the candidates in rank
+            :param scores: the scores of the candidates
+            :return: a DataFrame of the ranking
+        """
+        with profiling.stage('format', rows=len(rank)):
+            return GeoExpertRetrieval._formatRanking(
+                query, rank_method, profile_type, rank, scores)
+
+    @staticmethod
+    def _formatRanking(query, rank_method, profile_type, rank, scores):
+        """ Make the DataFrame of a ranking list (ref: formatRanking)
+        """
         ranking = pd.DataFrame([{
             'topic_id': query['topic_id'],
             'region': query['region']['name'],
             'topic': query['topic']['name'],
             'associate_id': query['topic']['associate_id'],
             'candidate': r,
-            'rank_method': rank_method.__name__,
+            'rank_method': getattr(rank_method, '__name__', rank_method),
             'profile_type': profile_type.__name__,
             'rank': i + 1,
             'score': s,
@@ -398,10 +1175,17 @@ class GeoExpertRetrieval(object):
                    'rank_method', 'profile_type', 'region', 'topic',
                    'associate_id']
 
-    def batchQuery(self, topics, metrics, profile_type, cutoff=5):
-        """ batchquery
+    @staticmethod
+    def iterQueries(topics):
+        """ Format the topics as queries grouped by their regions
+
+        :topics: a DataFrame of topics
+        :returns: a generator of (region_name, [queries]) in the order of the
+                  first appearance of the regions
+
         """
-        rankings = pd.DataFrame(columns=GeoExpertRetrieval.RANK_SCHEMA)
+        groups = dict()
+        order = list()
         for t in topics.values:
             t = dict(zip(topics.columns, t))
             q = GeoExpertRetrieval.formatQuery(
@@ -411,17 +1195,428 @@ class GeoExpertRetrieval(object):
                 t['region'],
                 REGIONS[t['region']]['value'],
                 t['topic_id'][0])
+            if t['region'] not in groups:
+                groups[t['region']] = list()
+                order.append(t['region'])
+            groups[t['region']].append(q)
+        for r in order:
+            yield r, groups[r]
+
+    @staticmethod
+    def topicUnits(topic_id, metrics, profile_type):
+        """ Return the units (topic_id, rank_method, profile_type) of the
+            ranking lists of a topic
+
+        :topic_id: the id of the topic
+        :metrics: a list of metrics
+        :profile_type: a list of profile types
+        :returns: a list of units
+
+        """
+        return [(topic_id, mtc.__name__, pf_type.__name__)
+                for mtc in metrics
+                if not ('poi' in topic_id and mtc == diversity_metrics)
+                for pf_type in profile_type]
+
+    def rankTopic(self, kbase, query, metrics, profile_type, cutoff=5,
+                  skip=None):
+        """ Rank the experts for one topic with all the metrics and profile
+            types sharing the check-ins and their VisitAggregate
+
+        :kbase: the KnowledgeBase holding the check-ins of the topic
+        :query: the formatted query of the topic
+        :metrics: a list of metrics
+        :profile_type: a list of profile types
+        :cutoff: the length of each ranking list
+        :skip: a set of units (ref: topicUnits) which are not ranked
+        :returns: a list of rankings
+
+        """
+        rankings = list()
+        for mtc in metrics:
+            if ('poi' in query['topic_id']) and mtc == diversity_metrics:
+                continue
+            for pf_type in profile_type:
+                if skip and (query['topic_id'], mtc.__name__,
+                             pf_type.__name__) in skip:
+                    continue
+                rankings.append(self.rankKnowledgeBase(kbase, query, mtc,
+                                                       pf_type, cutoff))
+        return rankings
+
+    @staticmethod
+    def sweepTopic(kbase, query, decay_rates, refdates, profile_type,
+                   cutoff=5):
+        """ Rank the experts for one topic by recency_metrics and RD_metrics
+            with all the settings of decay rates and refdates
+
+        :kbase: the KnowledgeBase holding the check-ins of the topic
+        :query: the formatted query of the topic
+        :decay_rates: a sequence of decay rates
+        :refdates: a sequence of reference dates
+        :profile_type: a list of profile types
+        :cutoff: the length of each ranking list
+        :returns: a list of rankings where the rank_method is named by
+                  sweep_name
+
+        """
+        rankings = list()
+        for pf_type in profile_type:
+            if pf_type is rankActiveDayProfile:
+                profile = kbase.aggregate.activeday
+            else:
+                profile = kbase.aggregate.checkin
+            for name, rank, scores in sweep_metrics(profile, decay_rates,
+                                                    refdates, cutoff):
+                rankings.append(GeoExpertRetrieval.formatRanking(
+                    query, name, pf_type, rank, scores))
+        return rankings
+
+    def iterSweep(self, topics, decay_rates, refdates, profile_type,
+                  cutoff=5):
+        """ Rank the topics with all the settings of decay rates and refdates
+            for tuning recency_metrics and RD_metrics, where the check-ins
+            are loaded once per region.
+
+        :topics: a DataFrame of topics
+        :decay_rates: a sequence of decay rates
+        :refdates: a sequence of reference dates
+        :profile_type: a list of profile types
+        :cutoff: the length of each ranking list
+        :returns: a generator of rankings in RANK_SCHEMA
+
+        """
+        for region_name, queries in GeoExpertRetrieval.iterQueries(topics):
+            self._logger.info('Loading %s...', region_name)
+            try:
+                rkbase = self.fetchRegion(REGIONS[region_name])
+            except ValueError:
+                self._logger.exception('Failed at loading %s', region_name)
+                continue
+            for q in queries:
+                self._logger.info('Sweeping %(topic_id)s...', q)
+                try:
+                    kbase = rkbase.select(q['topic']['value'])
+                    rankings = self.sweepTopic(kbase, q, decay_rates,
+                                               refdates, profile_type, cutoff)
+                except ValueError:
+                    self._logger.exception('Failed at %(topic_id)s', q)
+                    continue
+                for rank in rankings:
+                    yield rank
+
+    def batchSweep(self, topics, decay_rates, refdates, profile_type,
+                   cutoff=5):
+        """ Return the rankings of iterSweep in a DataFrame of RANK_SCHEMA
+        """
+        return _concatRankings(self.iterSweep(topics, decay_rates, refdates,
+                                              profile_type, cutoff))
+
+    def rankRegion(self, region_name, queries, metrics, profile_type,
+                   cutoff=5, rkbase=None, skip=None):
+        """ Rank the topics in one region where the check-ins are loaded once
+            for the region and each topic is selected from them in memory.
+
+        :region_name: the name of the region ref: REGIONS
+        :queries: the formatted queries of the topics in the region
+        :metrics: a list of metrics
+        :profile_type: a list of profile types
+        :cutoff: the length of each ranking list
+        :rkbase: the KnowledgeBase of the region if it is already loaded
+        :skip: a set of units (ref: topicUnits) which are not ranked
+        :returns: a generator of rankings
+
+        """
+        if rkbase is None:
+            self._logger.info('Loading %s...', region_name)
+            try:
+                with profiling.stage('region', region=region_name):
+                    rkbase = self.fetchRegion(REGIONS[region_name])
+            except ValueError:
+                self._logger.exception('Failed at loading %s', region_name)
+                return
+        for q in queries:
             self._logger.info('Processing %(topic_id)s...', q)
             try:
-                for mtc in metrics:
-                    if ('poi' in t['topic_id']) and mtc == diversity_metrics:
+                with profiling.stage('topic', topic_id=q['topic_id'],
+                                     region=region_name):
+                    with profiling.stage('select') as info:
+                        kbase = rkbase.select(q['topic']['value'])
+                        info['rows'] = len(kbase.checkins)
+                    ranks = self.rankTopic(kbase, q, metrics, profile_type,
+                                           cutoff, skip)
+            except ValueError:
+                self._logger.exception('Failed at %(topic_id)s', q)
+                continue
+            for rank in ranks:
+                yield rank
+
+    def _prefetchTopics(self, topics, depth):
+        """ Yield (query, kbase) of the topics in the order of iterQueries,
+            where a background thread loads the regions and selects the
+            check-ins of the topics ahead of the consumer.
+
+            At most depth topics are waiting in the queue, so the thread
+            blocks once it is depth topics ahead.
+        """
+        units = queue.Queue(maxsize=max(1, depth))
+        stop = threading.Event()
+        done = object()
+        failure = list()
+
+        def put(unit):
+            """ Put the unit unless the consumer has stopped """
+            while not stop.is_set():
+                try:
+                    units.put(unit, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            """ Load the topics region by region """
+            try:
+                for region_name, queries in \
+                        GeoExpertRetrieval.iterQueries(topics):
+                    self._logger.info('Loading %s...', region_name)
+                    try:
+                        with profiling.stage('region', region=region_name):
+                            rkbase = self.fetchRegion(REGIONS[region_name])
+                    except ValueError:
+                        self._logger.exception('Failed at loading %s',
+                                               region_name)
                         continue
-                    for pf_type in profile_type:
-                        rank = self.rankExperts(q, mtc, pf_type, cutoff)
-                        rankings = rankings.append(rank)
+                    for q in queries:
+                        try:
+                            with profiling.stage(
+                                    'select', topic_id=q['topic_id'],
+                                    region=region_name) as info:
+                                kbase = rkbase.select(q['topic']['value'])
+                                info['rows'] = len(kbase.checkins)
+                        except ValueError:
+                            self._logger.exception('Failed at %(topic_id)s',
+                                                   q)
+                            continue
+                        if not put((q, kbase)):
+                            return
+            except Exception as err:  # pylint: disable=broad-except
+                failure.append(err)
+            finally:
+                put(done)
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                unit = units.get()
+                if unit is done:
+                    break
+                yield unit
+        finally:
+            stop.set()
+            producer.join()
+        if failure:
+            raise failure[0]
+
+    def _prefetchRankings(self, topics, metrics, profile_type, cutoff,
+                          prefetch, skip=None):
+        """ Rank the topics while the check-ins of the next topics are
+            loaded in the background (ref: _prefetchTopics)
+        """
+        for q, kbase in self._prefetchTopics(topics, prefetch):
+            self._logger.info('Processing %(topic_id)s...', q)
+            try:
+                with profiling.stage('topic', topic_id=q['topic_id'],
+                                     region=q['region']['name']):
+                    ranks = self.rankTopic(kbase, q, metrics, profile_type,
+                                           cutoff, skip)
             except ValueError:
                 self._logger.exception('Failed at %(topic_id)s', q)
-        return rankings
+                continue
+            for rank in ranks:
+                yield rank
+
+    def _parallelRankings(self, topics, metrics, profile_type, cutoff,
+                          workers, skip=None):
+        """ Rank the topics in a pool of processes
+
+            Each region is loaded once in this process and the check-ins of
+            its topics are selected here, so the workers only receive chunks
+            of topics with their check-ins and never load a region. The
+            rankings are yielded in the same order as ranking the topics
+            serially.
+        """
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(self.name, ))
+        try:
+            for region_name, queries in \
+                    GeoExpertRetrieval.iterQueries(topics):
+                self._logger.info('Loading %s...', region_name)
+                try:
+                    with profiling.stage('region', region=region_name):
+                        rkbase = self.fetchRegion(REGIONS[region_name])
+                except ValueError:
+                    self._logger.exception('Failed at loading %s',
+                                           region_name)
+                    continue
+                units = list()
+                for q in queries:
+                    try:
+                        with profiling.stage('select',
+                                             topic_id=q['topic_id']) as info:
+                            kbase = rkbase.select(q['topic']['value'])
+                            info['rows'] = len(kbase.checkins)
+                    except ValueError:
+                        self._logger.exception('Failed at %(topic_id)s', q)
+                        continue
+                    units.append((q, kbase))
+                del rkbase  # Only the check-ins of the topics are kept
+                size = max(1, int(np.ceil(len(units) / float(workers * 4))))
+                tasks = [(units[i:i + size], metrics, profile_type, cutoff,
+                          skip) for i in range(0, len(units), size)]
+                for ranks in pool.imap(_rank_in_worker, tasks):
+                    for rank in ranks:
+                        yield rank
+        finally:
+            pool.close()
+            pool.join()
+
+    def iterRankings(self, topics, metrics, profile_type, cutoff=5,
+                     workers=1, prefetch=0, skip=None):
+        """ Rank the topics and yield each ranking list as soon as it is
+            ranked (ref: batchQuery for the parameters)
+
+        :skip: a set of units (ref: topicUnits) which are not ranked, where
+            the topics without any other unit are not loaded at all
+        :returns: a generator of rankings in RANK_SCHEMA
+
+        """
+        if skip:
+            pending = [any(u not in skip for u in
+                           GeoExpertRetrieval.topicUnits(t, metrics,
+                                                         profile_type))
+                       for t in topics['topic_id']]
+            topics = topics[np.array(pending, dtype=bool)]
+        if workers > 1:
+            return self._parallelRankings(topics, metrics, profile_type,
+                                          cutoff, workers, skip)
+        elif prefetch > 0:
+            return self._prefetchRankings(topics, metrics, profile_type,
+                                          cutoff, prefetch, skip)
+        return (rank for region_name, queries
+                in GeoExpertRetrieval.iterQueries(topics)
+                for rank in self.rankRegion(region_name, queries,
+                                            metrics, profile_type,
+                                            cutoff, skip=skip))
+
+    def batchQuery(self, topics, metrics, profile_type, cutoff=5,
+                   workers=1, prefetch=0):
+        """ batchquery
+
+            Check-ins are loaded once per region and each topic is selected
+            from the loaded region in memory.
+            :param workers: the number of processes ranking the topics in
+                parallel, which receive the check-ins of their topics from
+                the regions loaded in this process
+            :param prefetch: the number of topics loaded ahead by a
+                background thread while ranking the current one (0 means
+                loading and ranking in turn)
+        """
+        return _concatRankings(self.iterRankings(
+            topics, metrics, profile_type, cutoff, workers=workers,
+            prefetch=prefetch))
+
+
+def _concatRankings(rankings):
+    """ Concatenate the rankings at once into a DataFrame of RANK_SCHEMA
+    """
+    rankings = [r for r in rankings if len(r) > 0]
+    if len(rankings) == 0:
+        return pd.DataFrame(columns=GeoExpertRetrieval.RANK_SCHEMA)
+    return pd.concat(rankings, ignore_index=True)\
+        [GeoExpertRetrieval.RANK_SCHEMA]
+
+
+class RankingWriter(object):
+    """ Writing rankings to a CSV file in the columns of RANK_SCHEMA as they
+        are ranked, where each ranking is flushed once written so that the
+        partial results can be read during long runs.
+    """
+    def __init__(self, sink, append=False):
+        """ Open the sink and write the header unless appending
+
+        :sink: a path or a file object
+        :append: whether to append to an existing file without the header
+
+        """
+        super(RankingWriter, self).__init__()
+        self._owned = not hasattr(sink, 'write')
+        self._fout = open(sink, 'a' if append else 'w') if self._owned \
+            else sink
+        self.rows = 0
+        if not append:
+            self._fout.write(','.join(GeoExpertRetrieval.RANK_SCHEMA) + '\n')
+            self._fout.flush()
+
+    def write(self, ranking):
+        """ Write a ranking and flush it
+        """
+        if len(ranking) == 0:
+            return
+        ranking[GeoExpertRetrieval.RANK_SCHEMA].to_csv(
+            self._fout, float_format='%.3f', index=False, header=False)
+        self._fout.flush()
+        self.rows += len(ranking)
+
+    def writeAll(self, rankings, checkpoint=None):
+        """ Write the rankings one by one
+
+        :rankings: an iterable of rankings
+        :checkpoint: a Checkpoint recording each ranking written
+
+        """
+        for ranking in rankings:
+            self.write(ranking)
+            if checkpoint is not None and len(ranking) > 0:
+                checkpoint.record((ranking['topic_id'].iat[0],
+                                   ranking['rank_method'].iat[0],
+                                   ranking['profile_type'].iat[0]),
+                                  self._fout.tell())
+
+    def close(self):
+        """ Close the sink if it was opened by the writer
+        """
+        if self._owned:
+            self._fout.close()
+
+
+_WORKER = dict()
+
+
+def _init_worker(name):
+    """ Initialize the retrieval of the worker process, which ranks the
+        check-ins sent to it without connecting to Mongo
+    """
+    np.random.seed()  # Otherwise all forked workers share the random states
+    _WORKER['ger'] = GeoExpertRetrieval(name, None)
+
+
+def _rank_in_worker(task):
+    """ Rank a chunk of topics with their check-ins within a worker process
+    """
+    units, metrics, profile_type, cutoff, skip = task
+    ger = _WORKER['ger']
+    rankings = list()
+    for q, kbase in units:
+        ger._logger.info('Processing %(topic_id)s...', q)
+        try:
+            rankings.extend(ger.rankTopic(kbase, q, metrics, profile_type,
+                                          cutoff, skip))
+        except ValueError:
+            ger._logger.exception('Failed at %(topic_id)s', q)
+    return rankings
 
 
 METRICS = [naive_metrics,
@@ -432,20 +1627,83 @@ METRICS = [naive_metrics,
            RD_metrics]
 PROFILE_TYPES = [rankCheckinProfile,
                  rankActiveDayProfile]
+# The deterministic metrics precomputed in ExpertIndex
+INDEX_METRICS = [m for m in METRICS if m is not random_metrics]
+# The metrics only using the per user x pid visits
+PUSHDOWN_METRICS = [naive_metrics,
+                    diversity_metrics,
+                    random_metrics,
+                    bao2012_metrics]
 
 
 def run_experiment(outfile, topicfile, db='geoexpert', coll='checkin',
-                   cutoff=5):
+                   cutoff=5, workers=1, snapshot=None, compact=False,
+                   partitions=None, cache_dir=None, cache_size=1024,
+                   prefetch=0, checkpoint=None):
     """ Running a set of queries to generate ranking lists to topics.
+
+        If a checkpoint manifest is given, the ranking lists already written
+        to the outfile by a previous run are skipped and the missing ones
+        are appended.
     """
     topics = pd.read_csv(topicfile)
-    checkin_collection = pymongo.MongoClient()[db][coll]
-    ger = GeoExpertRetrieval('all', checkin_collection)
+    checkin_collection = None
+    if snapshot is None:
+        checkin_collection = pymongo.MongoClient()[db][coll]
+    cache = None
+    if cache_dir is not None:
+        cache = KnowledgeBaseCache(cache_size << 20, cache_dir)
+    ger = GeoExpertRetrieval('all', checkin_collection, snapshot, compact,
+                             partitions, cache)
+
+    append = False
+    if checkpoint is not None:
+        if hasattr(outfile, 'write'):
+            raise ValueError('Resuming needs the path to the output.')
+        checkpoint = Checkpoint(checkpoint)
+        append = checkpoint.resume(outfile)
 
-    # Do batch ranking with all the parameters
-    rankings = ger.batchQuery(topics, METRICS, PROFILE_TYPES, cutoff)
-    rankings.to_csv(outfile, float_format='%.3f', index=False,
-                    names=GeoExpertRetrieval.RANK_SCHEMA)
+    # Do batch ranking with all the parameters, writing each ranking list
+    # as soon as it is ranked
+    writer = RankingWriter(outfile, append=append)
+    try:
+        writer.writeAll(ger.iterRankings(topics, METRICS, PROFILE_TYPES,
+                                         cutoff, workers=workers,
+                                         prefetch=prefetch,
+                                         skip=checkpoint and checkpoint.done),
+                        checkpoint)
+    finally:
+        writer.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        if cache is not None:
+            cache.close()
+
+
+def run_sweep(outfile, topicfile, decay_rates, refdates, db='geoexpert',
+              coll='checkin', cutoff=5, snapshot=None, compact=False,
+              partitions=None, cache_dir=None, cache_size=1024):
+    """ Running a set of queries with recency_metrics and RD_metrics over
+        all the settings of decay rates and refdates, where the ranking lists
+        can be evaluated by mtrec_eval for picking the best setting.
+    """
+    topics = pd.read_csv(topicfile)
+    checkin_collection = None
+    if snapshot is None:
+        checkin_collection = pymongo.MongoClient()[db][coll]
+    cache = None
+    if cache_dir is not None:
+        cache = KnowledgeBaseCache(cache_size << 20, cache_dir)
+    ger = GeoExpertRetrieval('all', checkin_collection, snapshot, compact,
+                             partitions, cache)
+    writer = RankingWriter(outfile)
+    try:
+        writer.writeAll(ger.iterSweep(topics, decay_rates, refdates,
+                                      PROFILE_TYPES, cutoff))
+    finally:
+        writer.close()
+        if cache is not None:
+            cache.close()
 
 
 def console():
@@ -477,13 +1735,92 @@ def console():
         '-k', '--cutoff', dest='cutoff', action='store',
         metavar='COLLECTION', default=5, type=int,
         help='The collection containing the check-in profile of condidates')
+    parser.add_argument(
+        '-w', '--workers', dest='workers', action='store',
+        metavar='N', default=1, type=int,
+        help='The number of processes ranking topics in parallel')
+    parser.add_argument(
+        '-s', '--snapshot', dest='snapshot', action='store',
+        metavar='FILE', default=None,
+        help='A Parquet snapshot of check-ins used instead of mongodb')
+    parser.add_argument(
+        '--compact', dest='compact', action='store_true', default=False,
+        help='Keeping the check-ins in memory as categorical codes')
+    parser.add_argument(
+        '-p', '--partitions', dest='partitions', action='store',
+        metavar='N', default=None, type=int,
+        help='The number of concurrent cursors loading each region')
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', action='store',
+        metavar='DIR', default=None,
+        help='Caching the loaded check-ins in the directory across runs')
+    parser.add_argument(
+        '--cache-size', dest='cache_size', action='store',
+        metavar='MB', default=1024, type=int,
+        help='The size of the check-ins cached in memory')
+    parser.add_argument(
+        '--prefetch', dest='prefetch', action='store',
+        metavar='N', default=0, type=int,
+        help='The number of topics loaded ahead while ranking')
+    parser.add_argument(
+        '--checkpoint', dest='checkpoint', action='store',
+        metavar='FILE', default=None,
+        help='A manifest of the ranking lists written, for resuming a run '
+        'into the same output')
+    parser.add_argument(
+        '--profile', dest='profile', action='store',
+        metavar='FILE', default=None,
+        help='Recording the time, rows and peak RSS of every stage in the '
+        'main process to the file in JSON lines and printing a summary')
+    parser.add_argument(
+        '--sweep-decay', dest='sweep_decay', action='store',
+        metavar='D,D,...', default=None,
+        help='Sweeping recency_metrics and RD_metrics over the decay rates '
+        'instead of running all the metrics')
+    parser.add_argument(
+        '--sweep-refdate', dest='sweep_refdate', action='store',
+        metavar='DATE,DATE,...', default=None,
+        help='The refdates of the sweep (default: %s)' % REFDATE_DEFAULT)
     parser.add_argument(
         'topic', metavar='TOPIC', nargs=1,
         help='The topic file used for experiments.')
     args = parser.parse_args()
-    run_experiment(args.output, args.topic[0],
-                   db=args.db, coll=args.collection,
-                   cutoff=args.cutoff)
+    sweep = args.sweep_decay is not None or args.sweep_refdate is not None
+    if sweep and (args.workers > 1 or args.prefetch > 0 or
+                  args.checkpoint is not None):
+        parser.error('--workers, --prefetch and --checkpoint are not '
+                     'supported by --sweep-decay and --sweep-refdate')
+    profiler = None
+    if args.profile is not None:
+        profiler = profiling.Profiler(open(args.profile, 'w'))
+        profiling.enable(profiler)
+    try:
+        if sweep:
+            decay_rates = [DECAYRATE_DEFAULT]
+            if args.sweep_decay is not None:
+                decay_rates = [float(d) for d in args.sweep_decay.split(',')]
+            refdates = [REFDATE_DEFAULT]
+            if args.sweep_refdate is not None:
+                refdates = [np.datetime64(r)
+                            for r in args.sweep_refdate.split(',')]
+            run_sweep(args.output, args.topic[0], decay_rates, refdates,
+                      db=args.db, coll=args.collection, cutoff=args.cutoff,
+                      snapshot=args.snapshot, compact=args.compact,
+                      partitions=args.partitions,
+                      cache_dir=args.cache_dir, cache_size=args.cache_size)
+            return
+        run_experiment(args.output, args.topic[0],
+                       db=args.db, coll=args.collection,
+                       cutoff=args.cutoff, workers=args.workers,
+                       snapshot=args.snapshot, compact=args.compact,
+                       partitions=args.partitions,
+                       cache_dir=args.cache_dir, cache_size=args.cache_size,
+                       prefetch=args.prefetch, checkpoint=args.checkpoint)
+    finally:
+        if profiler is not None:
+            profiling.disable()
+            profiler.sink.close()
+            sys.stderr.write(profiler.report())
 
 if __name__ == '__main__':
     console()
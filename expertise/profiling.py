@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: profiling.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: none
+Description:
+    Recording wall time, rows and peak RSS of the stages of ranking
+"""
+
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import numpy as np
+import pandas as pd
+
+
+def peak_rss_mb():
+    """ Return the peak resident set size of the process so far in MB or
+        None if it is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    return peak / 1048576. if sys.platform == 'darwin' else peak / 1024.
+
+
+def _descending(values):
+    """ Return the positions of the values from the largest, keeping the
+        order of ties, which works with the sorting APIs of all pandas
+    """
+    return np.argsort(-np.asarray(values, dtype=np.float64), kind='mergesort')
+
+
+class Profiler(object):
+
+    """ Collecting a record for every stage run, i.e., the wall time, the
+        rows processed, the peak RSS of the process at the end of the stage
+        and the tags of the stage and of the stages enclosing it (e.g., the
+        topic_id of the topic being ranked).
+
+        The records are kept for the summary and written to the sink as JSON
+        lines if a sink is given.
+    """
+
+    def __init__(self, sink=None):
+        """ Initialize an empty profiler
+
+        :sink: a file object for the records in JSON lines
+
+        """
+        super(Profiler, self).__init__()
+        self.sink = sink
+        self.records = list()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _tags(self):
+        """ The tags of the stages enclosing the current one in the thread
+        """
+        if not hasattr(self._local, 'tags'):
+            self._local.tags = [dict()]
+        return self._local.tags
+
+    def add(self, name, wall, rows=None, **tags):
+        """ Add a record of a stage measured by the caller
+
+        :name: the name of the stage
+        :wall: the wall time in seconds
+        :rows: the number of rows processed
+        :returns: the record
+
+        """
+        record = dict(self._tags()[-1])
+        record.update(tags)
+        record.update({'stage': name, 'wall': wall, 'rows': rows,
+                       'peak_rss_mb': peak_rss_mb()})
+        with self._lock:
+            self.records.append(record)
+            if self.sink is not None:
+                self.sink.write(json.dumps(record, default=str) + '\n')
+        return record
+
+    @contextmanager
+    def stage(self, name, **tags):
+        """ Measure the stage run in the with statement, which yields a dict
+            where the rows and other tags of the stage can be set
+        """
+        stack = self._tags()
+        context = dict(stack[-1])
+        context.update(tags)
+        stack.append(context)
+        info = dict()
+        start = time.time()
+        try:
+            yield info
+        finally:
+            wall = time.time() - start
+            stack.pop()
+            tags.update(info)
+            self.add(name, wall, **tags)
+
+    def summary(self):
+        """ Return a DataFrame of the count, wall time, rows and peak RSS per
+            stage, ordered by the total wall time
+        """
+        with self._lock:
+            records = pd.DataFrame(self.records)
+        if len(records) == 0:
+            return records
+        records['rows'] = records['rows'].fillna(0)
+        grouped = records.groupby('stage')
+        summary = pd.DataFrame({
+            'count': grouped['wall'].count(),
+            'total_s': grouped['wall'].sum(),
+            'mean_ms': grouped['wall'].mean() * 1000,
+            'max_ms': grouped['wall'].max() * 1000,
+            'rows': grouped['rows'].sum(),
+            'peak_rss_mb': grouped['peak_rss_mb'].max()},
+            columns=['count', 'total_s', 'mean_ms', 'max_ms', 'rows',
+                     'peak_rss_mb'])
+        return summary.iloc[_descending(summary['total_s'])]
+
+    def slowest(self, stage='topic', by='topic_id', top=10):
+        """ Return the total wall time of the slowest values of a tag in a
+            stage, e.g., the slowest topics
+        """
+        with self._lock:
+            records = pd.DataFrame(self.records)
+        if len(records) == 0 or by not in records:
+            return pd.Series([], dtype=float)
+        records = records[records['stage'] == stage]
+        walls = records.groupby(by)['wall'].sum()
+        return walls.iloc[_descending(walls)[:top]]
+
+    def report(self):
+        """ Return the summary and the slowest topics as text tables
+        """
+        lines = ['Stages:', self.summary().to_string(
+            float_format=lambda x: '%.3f' % x)]
+        slowest = self.slowest()
+        if len(slowest) > 0:
+            lines += ['', 'Slowest topics (s):', slowest.to_string()]
+        return '\n'.join(lines) + '\n'
+
+
+_CURRENT = [None]
+
+
+def current():
+    """ Return the active Profiler or None
+    """
+    return _CURRENT[0]
+
+
+def enable(profiler):
+    """ Make the profiler active, which records the stages from now on
+    """
+    _CURRENT[0] = profiler
+
+
+def disable():
+    """ Stop recording the stages
+    """
+    _CURRENT[0] = None
+
+
+@contextmanager
+def stage(name, **tags):
+    """ Measure a stage with the active Profiler if there is one, otherwise
+        the stage is run as it is (ref: Profiler.stage)
+    """
+    profiler = _CURRENT[0]
+    if profiler is None:
+        yield dict()
+        return
+    with profiler.stage(name, **tags) as info:
+        yield info
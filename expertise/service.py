@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: service.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: none
+Description:
+    A resident HTTP/JSON service ranking geo-experts from the check-ins of
+    the regions kept in memory
+
+    GET /rank?region=Chicago&topic_type=p&associate_id=...&cutoff=5
+             &metric=naive_metrics&profile=rankCheckinProfile
+    GET /stats
+"""
+
+import json
+import time
+import argparse
+import logging
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from expertise import ger
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+METRICS = dict((m.__name__, m) for m in ger.METRICS)
+PROFILE_TYPES = dict((p.__name__, p) for p in ger.PROFILE_TYPES)
+
+
+class LatencyRecorder(object):
+
+    """ Keeping the latencies of the latest requests for percentiles
+    """
+
+    def __init__(self, size=10000):
+        super(LatencyRecorder, self).__init__()
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.counts = {'ok': 0, 'error': 0, 'timeout': 0, 'busy': 0}
+
+    def record(self, latency, status='ok'):
+        """ Record the latency in seconds of a request with its status
+        """
+        with self._lock:
+            self._latencies.append(latency)
+            self.counts[status] += 1
+
+    def stats(self, percentiles=(50, 90, 99)):
+        """ Return the counts and the latency percentiles in milliseconds
+        """
+        with self._lock:
+            latencies = np.array(self._latencies, dtype=np.float64)
+            stats = dict(self.counts)
+        for p in percentiles:
+            stats['p%d_ms' % p] = float(np.percentile(latencies, p) * 1000) \
+                if len(latencies) else None
+        return stats
+
+
+class ServiceBusy(Exception):
+
+    """ Raised when the rankings running and waiting fill all the slots
+    """
+
+    pass
+
+
+class ExpertService(object):
+
+    """ Ranking the experts of topics from the check-ins of the regions
+        loaded once and kept in memory, or from the ExpertIndex of the
+        retrieval if it is given.
+
+        The rankings run in a pool of threads so that a request exceeding
+        the timeout is answered with an error instead of blocking the client.
+        A thread cannot be interrupted, so a timed-out ranking keeps running
+        in the pool and holds its slot until it finishes. The slots bound the
+        rankings running and waiting for a thread, and a request finding them
+        all taken is rejected with ServiceBusy instead of queueing behind the
+        timed-out ones.
+    """
+
+    def __init__(self, retrieval, timeout=10., threads=8, backlog=16):
+        """ Initialize the service
+
+        :retrieval: the GeoExpertRetrieval loading the check-ins
+        :timeout: the seconds a ranking may take
+        :threads: the number of rankings running at the same time
+        :backlog: the number of rankings waiting for a thread
+
+        """
+        super(ExpertService, self).__init__()
+        self.retrieval = retrieval
+        self.timeout = timeout
+        self.latency = LatencyRecorder()
+        self._pool = ThreadPool(threads)
+        self._slots = threading.BoundedSemaphore(threads + backlog)
+        self._regions = dict()
+        self._loading = dict()
+        self._lock = threading.Lock()
+
+    def warm(self, region_names=None):
+        """ Load the check-ins of the regions (default: all REGIONS)
+        """
+        for name in region_names or sorted(ger.REGIONS.iterkeys()):
+            self.region(name)
+
+    def region(self, region_name):
+        """ Return the KnowledgeBase of the region, loading it on first use
+
+            Each region is loaded under its own lock, so the requests to the
+            regions already loaded are not blocked by loading another one.
+        """
+        with self._lock:
+            if region_name in self._regions:
+                return self._regions[region_name]
+            loading = self._loading.setdefault(region_name, threading.Lock())
+        with loading:
+            with self._lock:
+                if region_name in self._regions:
+                    return self._regions[region_name]
+            _LOGGER.info('Loading %s...', region_name)
+            kbase = self.retrieval.fetchRegion(ger.REGIONS[region_name])
+            with self._lock:
+                self._regions[region_name] = kbase
+            return kbase
+
+    def _rank(self, query, rank_method, profile_type, cutoff):
+        """ Rank the experts for the query
+        """
+        index = self.retrieval.index
+        if index is not None:
+            hit = index.lookup(query, rank_method, profile_type, cutoff)
+            if hit is not None:
+                return ger.GeoExpertRetrieval.formatRanking(
+                    query, rank_method, profile_type, hit[0], hit[1])
+        kbase = self.region(query['region']['name'])\
+            .select(query['topic']['value'])
+        return ger.GeoExpertRetrieval.rankKnowledgeBase(
+            kbase, query, rank_method, profile_type, cutoff)
+
+    def _rankInSlot(self, query, rank_method, profile_type, cutoff):
+        """ Rank the experts for the query and free the slot taken for it
+        """
+        try:
+            return self._rank(query, rank_method, profile_type, cutoff)
+        finally:
+            self._slots.release()
+
+    def rank(self, params):
+        """ Rank the experts for a request
+
+        :params: a dict of region, topic_type ('p', 'c' or 'z'),
+            associate_id, and optionally topic, metric, profile and cutoff
+        :returns: a list of rows of RANK_SCHEMA
+        :raises: ValueError for bad requests, multiprocessing.TimeoutError
+            if the ranking exceeds the timeout, ServiceBusy if all the slots
+            are taken
+
+        """
+        try:
+            region_name = params['region']
+            query = ger.GeoExpertRetrieval.formatQuery(
+                params.get('topic_id', params['associate_id']),
+                params.get('topic', params['associate_id']),
+                params['associate_id'],
+                region_name,
+                ger.REGIONS[region_name]['value'],
+                params['topic_type'])
+            rank_method = METRICS[params.get('metric', 'naive_metrics')]
+            profile_type = PROFILE_TYPES[
+                params.get('profile', 'rankCheckinProfile')]
+            cutoff = int(params.get('cutoff', 5))
+        except KeyError as err:
+            raise ValueError('Unknown or missing parameter %s.' % err)
+        if query is None:
+            raise ValueError('Unknown topic_type %s.' % params['topic_type'])
+        if not self._slots.acquire(False):
+            raise ServiceBusy('Too many rankings running.')
+        ranking = self._pool.apply_async(
+            self._rankInSlot, (query, rank_method, profile_type, cutoff))\
+            .get(self.timeout)
+        return [dict((k, _jsonable(r[k])) for k in
+                     ger.GeoExpertRetrieval.RANK_SCHEMA)
+                for r in ranking.to_dict('records')]
+
+    def close(self):
+        """ Stop the pool of rankings
+        """
+        self._pool.terminate()
+
+
+def _jsonable(value):
+    """ Return the value as a JSON serializable type
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ExpertRequestHandler(BaseHTTPRequestHandler):
+
+    """ Serving /rank and /stats in JSON
+    """
+
+    def _reply(self, code, body):
+        """ Send the body as JSON
+        """
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Dispatch the GET requests
+        """
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == '/stats':
+            self._reply(200, service.latency.stats())
+            return
+        if url.path != '/rank':
+            self._reply(404, {'error': 'Not found.'})
+            return
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        start = time.time()
+        try:
+            ranking = service.rank(params)
+        except TimeoutError:
+            service.latency.record(time.time() - start, 'timeout')
+            self._reply(504, {'error': 'Ranking timed out.'})
+            return
+        except ServiceBusy as err:
+            service.latency.record(time.time() - start, 'busy')
+            self._reply(503, {'error': str(err)})
+            return
+        except ValueError as err:
+            service.latency.record(time.time() - start, 'error')
+            self._reply(400, {'error': str(err)})
+            return
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception('Failed at ranking %s', url.query)
+            service.latency.record(time.time() - start, 'error')
+            self._reply(500, {'error': 'Ranking failed.'})
+            return
+        latency = time.time() - start
+        service.latency.record(latency)
+        self._reply(200, {'ranking': ranking, 'latency_ms': latency * 1000})
+
+    def log_message(self, fmt, *args):
+        _LOGGER.debug(fmt, *args)
+
+
+class ExpertServer(ThreadingMixIn, HTTPServer):
+
+    """ A threaded HTTP server of an ExpertService
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, ExpertRequestHandler)
+        self.service = service
+
+
+def console():
+    """ An interface for starting the service
+    """
+    import pymongo
+    from expertise.expertindex import ExpertIndex
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+
+    parser = argparse.ArgumentParser(
+        description='Serving geo-expert rankings over HTTP in JSON with the '
+        'check-ins of the regions kept in memory')
+    parser.add_argument(
+        '-d', '--db', dest='db', action='store',
+        metavar='DB', default='geoexpert',
+        help='The name of the db instance in mongodb')
+    parser.add_argument(
+        '-c', '--collection', dest='collection', action='store',
+        metavar='COLLECTION', default='checkin',
+        help='The collection containing the check-in profile of condidates')
+    parser.add_argument(
+        '-s', '--snapshot', dest='snapshot', action='store',
+        metavar='FILE', default=None,
+        help='A Parquet snapshot of check-ins used instead of mongodb')
+    parser.add_argument(
+        '-i', '--index', dest='index', action='store',
+        metavar='FILE', default=None,
+        help='An ExpertIndex answering the rankings before the check-ins')
+    parser.add_argument(
+        '--host', dest='host', action='store', default='127.0.0.1',
+        help='The address to listen on')
+    parser.add_argument(
+        '--port', dest='port', action='store', default=8080, type=int,
+        help='The port to listen on')
+    parser.add_argument(
+        '-t', '--timeout', dest='timeout', action='store',
+        metavar='SECONDS', default=10., type=float,
+        help='The seconds a ranking may take')
+    parser.add_argument(
+        '--lazy', dest='lazy', action='store_true', default=False,
+        help='Loading the regions on first use instead of at start')
+    args = parser.parse_args()
+    collection = None
+    if args.snapshot is None:
+        collection = pymongo.MongoClient()[args.db][args.collection]
+    index = ExpertIndex(args.index) if args.index else None
+    retrieval = ger.GeoExpertRetrieval('service', collection, args.snapshot,
+                                       compact=True, index=index)
+    service = ExpertService(retrieval, timeout=args.timeout)
+    if not args.lazy:
+        service.warm()
+    server = ExpertServer((args.host, args.port), service)
+    _LOGGER.info('Serving on %s:%d', args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    console()
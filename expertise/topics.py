@@ -14,9 +14,10 @@ import logging
 import argparse
 import pandas as pd
 from pymongo import MongoClient
+import expertise.pandasmongo as pandasmongo
 from expertise.ger import KnowledgeBase
 from expertise.ger import REGIONS
-from expertise.ger import get_region
+from expertise.ger import assign_regions
 from stratified import stratified_samples
 
 
@@ -50,13 +51,31 @@ TOPIC_SCHEMA = ['topic_id',
                 'group']
 
 
+def load_unique_visits(query, chunksize=pandasmongo.CHUNKSIZE):
+    """ Load the check-ins with distinct (pid, user) chunk by chunk so that
+        only the distinct visits are kept in memory
+
+    :query: the query of the check-ins
+    :chunksize: the number of check-ins in a chunk
+    :returns: a DataFrame of check-ins
+
+    """
+    chunks = [ck.drop_duplicates(cols=['pid', 'user'])
+              for ck in pandasmongo.iterDataFrame(
+                  db.checkin, query, KnowledgeBase.DEFAULT_PROJECTION,
+                  chunksize=chunksize)]
+    if len(chunks) <= 0:
+        raise ValueError('No data returned from the query.')
+    return pd.concat(chunks, ignore_index=True)\
+        .drop_duplicates(cols=['pid', 'user'])
+
+
 def sampling_poi_topics(region, size, g_percentages):
     """ Sampling poi topics from the database
     """
     topics = pd.DataFrame(columns=TOPIC_SCHEMA)
-    kbase = KnowledgeBase.fromMongo(db.checkin, region['value'])
-    kbase.checkins.drop_duplicates(cols=['pid', 'user'], inplace=True)
-    for zcate, group in kbase.checkins.groupby('z_category'):
+    checkins = load_unique_visits(region['value'])
+    for zcate, group in checkins.groupby('z_category'):
         pidgroup = [pid + '\t' + pname
                     for pid, pname in group[['pid', 'place']].values]
         for gid, g in enumerate(stratified_samples(pidgroup,
@@ -81,13 +100,13 @@ def sampling_cate_topics(regions, size, g_percentages):
     checkins = None
     cate_set = set()
     for r in regions:
-        kbase = KnowledgeBase.fromMongo(db.checkin, r['value'])
+        rcheckins = load_unique_visits(r['value'])
         if checkins is not None:
-            cate_set = set(kbase.checkins['cid'].unique())
-            checkins = checkins.append(kbase.checkins, ignore_index=True)
+            cate_set = set(rcheckins['cid'].unique())
+            checkins = checkins.append(rcheckins, ignore_index=True)
         else:
-            cate_set &= set(kbase.checkins['cid'].unique())
-            checkins = kbase.checkins
+            cate_set &= set(rcheckins['cid'].unique())
+            checkins = rcheckins
     _LOGGER.info('%d checkins loaded for cate_topics', len(checkins))
     checkins.drop_duplicates(cols=['pid', 'user'], inplace=True)
     for zcate, group in checkins.groupby('z_category'):
@@ -159,23 +178,38 @@ def make_cate_topic(cate_id, topic_id, region):
     }
 
 
-def make_poi_topic(poi_id, topic_id):
-    """@todo: Docstring for make_poi_topic.
+def make_poi_topics(poi_ids, topic_ids):
+    """ Make the topics of POIs where the regions of all the POIs are
+        assigned at once
 
-    :poi_id: @todo
-    :returns: @todo
+    :poi_ids: a list of POI ids
+    :topic_ids: an iterator of topic ids, e.g., POI_ID
+    :returns: a list of topics
 
     """
-    poi = db.checkin.find_on({'place.id': poi_id, })['place']
-    region = get_region(poi['boundingbox']['coordinates'][0][0][1],
-                        poi['boundingbox']['coordinates'][0][0][0])
-    return {
-        'topic_id': topic_id,
+    pois = [db.checkin.find_one({'place.id': poi_id})['place']
+            for poi_id in poi_ids]
+    lats = [p['bounding_box']['coordinates'][0][0][1] for p in pois]
+    lons = [p['bounding_box']['coordinates'][0][0][0] for p in pois]
+    regions = assign_regions(lats, lons)
+    return [{
+        'topic_id': next(topic_ids),
         'topic': poi['name'],
         'region': region,
         'associate_id': poi_id,
-        'zcategory': poi['category']['zero_cateogry']
-    }
+        'zcategory': poi['category']['zero_category']
+    } for poi_id, poi, region in zip(poi_ids, pois, regions)]
+
+
+def make_poi_topic(poi_id, topic_id):
+    """ Make the topic of a POI (ref: make_poi_topics)
+
+    :poi_id: the id of the POI
+    :topic_id: the id of the topic
+    :returns: a topic
+
+    """
+    return make_poi_topics([poi_id], iter([topic_id]))[0]
 
 
 def console():
@@ -199,7 +233,8 @@ def console():
     else:
         if args.pois:
             with open(args.pois) as fin:
-                output_topics((make_poi_topic(l) for l in fin), sys.stdout)
+                output_topics(make_poi_topics([l.strip() for l in fin],
+                                              POI_ID), sys.stdout)
         if args.categories:
             with open(args.categories) as fin:
                 output_topics((make_cate_topic(*l.split(',', 2))
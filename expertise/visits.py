@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: visits.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: none
+Description:
+    Integer-coded visit aggregates shared by all the ranking metrics
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class CodedArray(object):
+    """ Values stored as positions in a shared dictionary which are only
+        decoded when indexed.
+
+        values........the dictionary of values
+        ids...........the positions of the coded values in the dictionary
+    """
+    def __init__(self, values, ids):
+        super(CodedArray, self).__init__()
+        self.values = np.asarray(values)
+        self.ids = np.asarray(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, positions):
+        return self.values[self.ids[positions]]
+
+    def __array__(self, dtype=None):
+        values = self.values[self.ids]
+        return values if dtype is None else values.astype(dtype)
+
+
+def _factorize(values):
+    """ Return (codes, uniques) of the values where the uniques are sorted.
+        For categorical values, the codes of the categories are reused and
+        only the categories present are kept without decoding them.
+    """
+    if hasattr(values, 'cat'):
+        used, codes = np.unique(values.cat.codes.values,
+                                return_inverse=True)
+        return codes, CodedArray(values.cat.categories.values, used)
+    return pd.factorize(values, sort=True)
+
+
+class _Encoder(object):
+    """ Coding values chunk by chunk with a growing dictionary
+    """
+    def __init__(self):
+        super(_Encoder, self).__init__()
+        self.index = pd.Index([])
+
+    def encode(self, values):
+        """ Return the codes of the values and add the new ones to the
+            dictionary
+        """
+        values = np.asarray(values)
+        codes = self.index.get_indexer(values)
+        new = codes < 0
+        if new.any():
+            self.index = self.index.append(pd.Index(pd.unique(values[new])))
+            codes[new] = self.index.get_indexer(values[new])
+        return codes
+
+    def sort(self, codes):
+        """ Return (codes, uniques) recoded for the sorted dictionary
+        """
+        order = np.argsort(self.index.values)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return rank[codes], self.index.values[order]
+
+
+def _bincount(index, weights, size):
+    """ Sum up the weights by the index, where each row of 2-D weights is
+        summed up separately.
+    """
+    if weights is None or np.ndim(weights) == 1:
+        return np.bincount(index, weights=weights, minlength=size)
+    weights = np.asarray(weights, dtype=np.float64)
+    keys = index + size * np.arange(len(weights))[:, np.newaxis]
+    return np.bincount(keys.ravel(), weights=weights.ravel(),
+                       minlength=size * len(weights))\
+        .reshape(len(weights), size)
+
+
+class VisitProfile(object):
+    """ The visits of a set of candidates coded as integer arrays.
+
+        users.........user names, indexed by user codes (an array or a
+                      CodedArray)
+        pids..........poi ids, indexed by pid codes (an array or a
+                      CodedArray)
+        ucodes........the user code of each visit
+        pcodes........the pid code of each visit
+        times.........the datetime64 of each visit (None if unknown)
+        counts........the number of visits each row stands for (None means
+                      every row is a single visit)
+
+        The per (user, pid) aggregates are computed once on the first
+        access and shared by all metrics reading from the profile.
+    """
+    def __init__(self, users, pids, ucodes, pcodes, times=None, counts=None):
+        super(VisitProfile, self).__init__()
+        self.users = users if isinstance(users, CodedArray) \
+            else np.asarray(users)
+        self.pids = pids if isinstance(pids, CodedArray) else np.asarray(pids)
+        self.ucodes = np.asarray(ucodes, dtype=np.int64)
+        self.pcodes = np.asarray(pcodes, dtype=np.int64)
+        self.times = times
+        self.counts = counts
+        self._pairs = None
+        self._totals = None
+
+    def __len__(self):
+        """ The number of rows in the profile
+        """
+        return len(self.ucodes)
+
+    def _pair_index(self):
+        """ Return (pair_ucodes, pair_pcodes, inverse) where inverse maps
+            each row to its (user, pid) pair.
+        """
+        if self._pairs is None:
+            npids = max(len(self.pids), 1)
+            keys = self.ucodes * npids + self.pcodes
+            uniq, inverse = np.unique(keys, return_inverse=True)
+            self._pairs = (uniq // npids, uniq % npids, inverse)
+        return self._pairs
+
+    @property
+    def pair_ucodes(self):
+        """ The user code of each (user, pid) pair
+        """
+        return self._pair_index()[0]
+
+    @property
+    def pair_pcodes(self):
+        """ The pid code of each (user, pid) pair
+        """
+        return self._pair_index()[1]
+
+    @property
+    def pair_counts(self):
+        """ The number of visits of each (user, pid) pair
+        """
+        return self.pair_sums(self.counts)
+
+    @property
+    def totals(self):
+        """ The number of visits of each user
+        """
+        if self._totals is None:
+            self._totals = np.bincount(self.ucodes, weights=self.counts,
+                                       minlength=len(self.users))
+        return self._totals
+
+    def pair_sums(self, weights=None):
+        """ Sum up the weights of rows per (user, pid) pair
+
+        :weights: an array of weights for each row (None means counting)
+            or a 2-D array with one row of weights per setting
+        :returns: an array aligned with the pairs (one row per setting)
+
+        """
+        pair_ucodes, _, inverse = self._pair_index()
+        return _bincount(inverse, weights, len(pair_ucodes))
+
+    def user_sums(self, pair_values):
+        """ Reduce values of (user, pid) pairs to values per user
+
+        :pair_values: an array aligned with the pairs or a 2-D array with
+            one row per setting
+        :returns: an array aligned with the users (one row per setting)
+
+        """
+        return _bincount(self.pair_ucodes, pair_values, len(self.users))
+
+    def time_diff(self, refdate, unit=np.timedelta64(1, 'D')):
+        """ Return the difference between each visit and the refdate
+
+        :refdate: the reference date as datetime64
+        :unit: the unit of the difference
+        :returns: an array of float
+
+        """
+        if self.times is None:
+            raise ValueError('No visiting time in the profile.')
+        return (self.times - refdate) / unit
+
+    @classmethod
+    def fromPairs(cls, users, pids, counts):
+        """ Make a profile from the visits already counted per (user, pid)
+
+        :users: the user of each pair
+        :pids: the pid of each pair
+        :counts: the number of visits of each pair
+        :returns: a VisitProfile without visiting times
+
+        """
+        ucodes, uniq_users = pd.factorize(users, sort=True)
+        pcodes, uniq_pids = pd.factorize(pids, sort=True)
+        return cls(uniq_users, uniq_pids, ucodes, pcodes,
+                   counts=np.asarray(counts, dtype=np.float64))
+
+    @classmethod
+    def fromGroupBy(cls, profiles):
+        """ Make a profile from check-ins grouped by users
+
+        :profiles: a DataFrameGroupBy of check-ins grouped by 'user'
+        :returns: a VisitProfile
+
+        """
+        return VisitAggregate(profiles.obj).checkin
+
+
+def _times(checkins):
+    """ Return (times, days) of the check-ins as datetime64 arrays
+    """
+    times = checkins['created_at'].values
+    if 'created_day' in checkins:
+        # days since epoch in a compact KnowledgeBase
+        days = checkins['created_day'].values.astype(np.int64)
+    elif 'created_date' in checkins:
+        days = checkins['created_date'].values
+    else:
+        days = times
+    return times, days.astype('datetime64[D]')
+
+
+class VisitAggregate(object):
+    """ All visits of a set of check-ins coded once so that every metric and
+        profile type can read from it without regrouping the check-ins.
+
+        checkin.......the VisitProfile with one row per check-in
+        activeday.....the VisitProfile with one row per (user, day, pid)
+
+        Check-ins without a user or a pid are not counted.
+    """
+    def __init__(self, checkins):
+        super(VisitAggregate, self).__init__()
+        valid = checkins['user'].notnull() & checkins['pid'].notnull()
+        if not valid.all():
+            checkins = checkins[valid]
+        ucodes, users = _factorize(checkins['user'])
+        pcodes, pids = _factorize(checkins['pid'])
+        times, days = _times(checkins)
+        self.days = days
+        self.checkin = VisitProfile(users, pids, ucodes, pcodes, times)
+        self._activeday = None
+
+    @classmethod
+    def fromChunks(cls, chunks):
+        """ Build the aggregate from chunks of check-ins, e.g., from
+            pandasmongo.iterDataFrame, keeping only the coded arrays of the
+            chunks in memory
+
+        :chunks: an iterable of DataFrames of check-ins
+        :returns: a VisitAggregate
+
+        """
+        users, pids = _Encoder(), _Encoder()
+        parts = list()
+        for checkins in chunks:
+            checkins = checkins[checkins['user'].notnull() &
+                                checkins['pid'].notnull()]
+            times, days = _times(checkins)
+            parts.append((users.encode(checkins['user'].values),
+                          pids.encode(checkins['pid'].values),
+                          times, days))
+        if len(parts) == 0:
+            raise ValueError('No data returned from the query.')
+        ucodes, pcodes, times, days = [np.concatenate(p) for p in zip(*parts)]
+        ucodes, uniq_users = users.sort(ucodes)
+        pcodes, uniq_pids = pids.sort(pcodes)
+        aggregate = cls.__new__(cls)
+        aggregate.days = days
+        aggregate.checkin = VisitProfile(uniq_users, uniq_pids, ucodes, pcodes,
+                                         times)
+        aggregate._activeday = None
+        return aggregate
+
+    @property
+    def activeday(self):
+        """ The profile counting all check-ins of a user at a poi on the
+            same day as one visit, where the visiting time is the day.
+        """
+        if self._activeday is None:
+            ck = self.checkin
+            days = self.days.view(np.int64)
+            if len(days):
+                days = days - days.min()
+            ndays = days.max() + 1 if len(days) else 1
+            npids = max(len(ck.pids), 1)
+            keys = (ck.ucodes * ndays + days) * npids + ck.pcodes
+            _, rows = np.unique(keys, return_index=True)
+            self._activeday = VisitProfile(
+                ck.users, ck.pids, ck.ucodes[rows], ck.pcodes[rows],
+                self.days[rows].astype(ck.times.dtype))
+        return self._activeday
+
+    @classmethod
+    def of(cls, checkins):
+        """ Return the aggregate of the check-ins, which can be a DataFrame
+            or an aggregate already built.
+        """
+        if isinstance(checkins, cls):
+            return checkins
+        return cls(checkins)
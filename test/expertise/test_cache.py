@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: test_cache.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: http://github.com/spacelis
+Description:
+    Testing the cache of KnowledgeBases
+"""
+# pylint: disable=too-many-public-methods
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+
+import expertise.ger as mt
+from expertise.cache import KnowledgeBaseCache
+from expertise.cache import _nbytes
+
+
+class TestKnowledgeBaseCache(unittest.TestCase):
+
+    """ Test the LRU eviction and invalidation"""
+
+    def setUp(self):
+        self.kbases = [mt.KnowledgeBase(pd.DataFrame({'id': range(100)}))
+                       for _ in range(3)]
+        self.size = int(self.kbases[0].checkins.memory_usage(index=True)
+                        .sum())
+
+    def test_lru(self):
+        """ test_lru evicting the least recently used """
+        cache = KnowledgeBaseCache(budget=2 * self.size)
+        cache.put('a', [1], self.kbases[0])
+        cache.put('b', [1], self.kbases[1])
+        self.assertIs(cache.get('a', [1]), self.kbases[0])
+        cache.put('c', [1], self.kbases[2])
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b', [1]))
+        self.assertIs(cache.get('a', [1]), self.kbases[0])
+        self.assertIs(cache.get('c', [1]), self.kbases[2])
+
+    def test_nbytes(self):
+        """ test_nbytes counting the strings in object columns """
+        checkins = pd.DataFrame({'user': ['user%08d' % i
+                                          for i in range(100)]})
+        shallow = int(checkins.memory_usage(index=True).sum())
+        self.assertGreater(_nbytes(checkins), shallow + 100 * 12)
+
+    def test_invalidation(self):
+        """ test_invalidation by the stamp """
+        cache = KnowledgeBaseCache(budget=2 * self.size)
+        cache.put('a', [1], self.kbases[0])
+        self.assertIsNone(cache.get('a', [2]))
+        self.assertEqual(len(cache), 0)
+
+    def test_spill(self):
+        """ test_spill writing entries on eviction and at close """
+        kbases = [mt.KnowledgeBase(pd.DataFrame({
+            'id': range(100),
+            'created_at': pd.date_range('2013-07-01', periods=100)}))
+            for _ in range(2)]
+        size = int(kbases[0].checkins.memory_usage(index=True).sum())
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = KnowledgeBaseCache(budget=size, spill_dir=tmpdir)
+            cache.put('a', [1], kbases[0])
+            self.assertEqual(os.listdir(tmpdir), [])
+            cache.put('b', [1], kbases[1])
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['a.json', 'a.parquet'])
+            cache.close()
+            self.assertEqual(len(os.listdir(tmpdir)), 4)
+            cache = KnowledgeBaseCache(budget=2 * size, spill_dir=tmpdir)
+            self.assertEqual(cache.get('b', [1]).checkins['id'].tolist(),
+                             range(100))
+            self.assertIsNone(cache.get('a', [2]))
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['b.json', 'b.parquet'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_stamp(self):
+        """ test_stamp reading the collection once """
+        queries = list()
+
+        class Collection(object):
+            """ A collection counting the queries """
+            full_name = 'geoexpert.checkin'
+
+            def find_one(self, *args, **kargs):
+                """ Return the latest check-in """
+                queries.append((args, kargs))
+                return {'_id': 7, 'created_at': '2013-07-06'}
+
+        cache = KnowledgeBaseCache()
+        self.assertEqual(cache.stamp(Collection()), ['7', '2013-07-06'])
+        self.assertEqual(cache.stamp(Collection()), ['7', '2013-07-06'])
+        self.assertEqual(len(queries), 2)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: test_checkpoint.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: http://github.com/spacelis
+Description:
+    Testing resuming runs from checkpoints
+"""
+# pylint: disable=too-many-public-methods
+import os
+import shutil
+import tempfile
+import unittest
+from itertools import islice
+import pandas as pd
+
+import expertise.ger as mt
+from expertise.checkpoint import Checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    """ Test skipping the units done and truncating partial units"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmpdir, 'rankings.csv')
+        self.manifest = os.path.join(self.tmpdir, 'rankings.manifest')
+        checkins = pd.DataFrame.from_records([
+            {'user': 'a', 'pid': 'p1', 'created_at': '2013-07-01'},
+            {'user': 'a', 'pid': 'p2', 'created_at': '2013-07-02'},
+            {'user': 'b', 'pid': 'p1', 'created_at': '2013-07-03'},
+            {'user': 'b', 'pid': 'p1', 'created_at': '2013-07-04'},
+            {'user': 'c', 'pid': 'p2', 'created_at': '2013-07-06'},
+        ])
+        checkins['created_at'] = pd.to_datetime(checkins['created_at'])
+        mt._add_created_date(checkins)
+        kbase = mt.KnowledgeBase(checkins)
+        self.ger = mt.GeoExpertRetrieval('test', None)
+        self.ger.fetchRegion = lambda region: kbase
+        self.topics = pd.DataFrame({'topic_id': ['p-1', 'p-2'],
+                                    'topic': ['p1', 'p2'],
+                                    'associate_id': ['p1', 'p2'],
+                                    'region': ['Chicago', 'Chicago']})
+        self.metrics = [mt.naive_metrics, mt.RD_metrics]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def rank(self, limit=None):
+        """ Rank the topics into the output, stopping after limit rankings """
+        checkpoint = Checkpoint(self.manifest)
+        writer = mt.RankingWriter(self.output,
+                                  append=checkpoint.resume(self.output))
+        rankings = self.ger.iterRankings(self.topics, self.metrics,
+                                         mt.PROFILE_TYPES,
+                                         skip=checkpoint.done)
+        writer.writeAll(islice(rankings, limit), checkpoint)
+        writer.close()
+        checkpoint.close()
+
+    def test_resume(self):
+        """ test_resume writing the same rows as an uninterrupted run """
+        expected = self.ger.batchQuery(self.topics, self.metrics,
+                                       mt.PROFILE_TYPES)
+        self.rank(limit=3)
+        self.assertEqual(len(Checkpoint(self.manifest).done), 3)
+        with open(self.output, 'a') as fout:
+            fout.write('p-2,1,partial')
+        with open(self.manifest, 'a') as fout:
+            fout.write('{"unit": ["p-2"')
+        self.rank()
+        written = pd.read_csv(self.output)
+        self.assertEqual(len(Checkpoint(self.manifest).done), 8)
+        self.assertEqual(written['topic_id'].tolist(),
+                         expected['topic_id'].tolist())
+        self.assertEqual(written['candidate'].tolist(),
+                         expected['candidate'].tolist())
+        self.assertEqual(written['rank_method'].tolist(),
+                         expected['rank_method'].tolist())
+
+    def test_restart(self):
+        """ test_restart from the beginning without a manifest """
+        with open(self.output, 'w') as fout:
+            fout.write('stale')
+        self.rank()
+        self.assertEqual(len(pd.read_csv(self.output)), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: test_expertindex.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: http://github.com/spacelis
+Description:
+    Testing the precomputed index of experts
+"""
+# pylint: disable=too-many-public-methods
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+import expertise.ger as mt
+from expertise.expertindex import ExpertIndex
+from expertise.expertindex import topic_key
+
+
+class TestExpertIndex(unittest.TestCase):
+
+    """ Test building and looking up the index"""
+
+    def setUp(self):
+        checkins = pd.DataFrame.from_records([
+            {'user': 'a', 'pid': 'p1', 'cid': 'c1', 'zcid': 'z1',
+             'created_at': '2013-07-01'},
+            {'user': 'a', 'pid': 'p2', 'cid': 'c1', 'zcid': 'z1',
+             'created_at': '2013-07-02'},
+            {'user': 'b', 'pid': 'p1', 'cid': 'c1', 'zcid': 'z1',
+             'created_at': '2013-07-03'},
+            {'user': 'b', 'pid': 'p1', 'cid': 'c1', 'zcid': 'z1',
+             'created_at': '2013-07-04'},
+            {'user': 'c', 'pid': 'p3', 'cid': 'c2', 'zcid': 'z1',
+             'created_at': '2013-07-06'},
+        ])
+        checkins['created_at'] = pd.to_datetime(checkins['created_at'])
+        mt._add_created_date(checkins)
+        self.rkbase = mt.KnowledgeBase(checkins)
+        self.index = ExpertIndex(':memory:', depth=2)
+        self.index.buildRegion('Chicago', self.rkbase, mt.INDEX_METRICS,
+                               mt.PROFILE_TYPES)
+
+    def tearDown(self):
+        self.index.close()
+
+    def query(self, value):
+        """ Return a formatted query of the topic in Chicago """
+        return {'topic_id': 'x', 'region': {'name': 'Chicago'},
+                'topic': {'name': 'x', 'associate_id': 'x', 'value': value}}
+
+    def test_lookup(self):
+        """ test_lookup the same as ranking the topic """
+        for value in [{'place.id': 'p1'}, {'place.category.id': 'c1'},
+                      {'place.category.zero_category': 'z1'}]:
+            rank, scores = self.rkbase.select(value).rank(
+                mt.rankCheckinProfile, mt.naive_metrics, cutoff=2)
+            hit = self.index.lookup(self.query(value), mt.naive_metrics,
+                                    mt.rankCheckinProfile, cutoff=2)
+            self.assertEqual(hit[0], list(rank))
+            self.assertEqual(hit[1], list(scores))
+
+    def test_miss(self):
+        """ test_miss on unknown topics, metrics and truncated lists """
+        self.assertIsNone(self.index.lookup(
+            self.query({'place.id': 'p9'}), mt.naive_metrics,
+            mt.rankCheckinProfile))
+        self.assertIsNone(self.index.lookup(
+            self.query({'place.id': 'p1'}), mt.random_metrics,
+            mt.rankCheckinProfile))
+        self.assertIsNone(self.index.lookup(
+            self.query({'place.category.id': 'c1'}), mt.naive_metrics,
+            mt.rankCheckinProfile, cutoff=5))
+        # The whole list is shorter than the depth
+        self.assertEqual(self.index.lookup(
+            self.query({'place.id': 'p3'}), mt.naive_metrics,
+            mt.rankCheckinProfile, cutoff=5)[0], ['c'])
+
+    def test_numeric_topic(self):
+        """ test_numeric_topic matching ids of numpy and Python types """
+        self.assertEqual(topic_key('Chicago', {'place.id': np.int64(5)}),
+                         topic_key('Chicago', {'place.id': 5}))
+        self.assertEqual(topic_key('Chicago', {'place.id': 5}),
+                         topic_key('Chicago', {'place.id': '5'}))
+        checkins = self.rkbase.checkins.copy()
+        checkins['cid'] = checkins['cid'].map({'c1': 1, 'c2': 2})
+        self.index.buildRegion('Chicago', mt.KnowledgeBase(checkins),
+                               mt.INDEX_METRICS, mt.PROFILE_TYPES)
+        hit = self.index.lookup(self.query({'place.category.id': 2}),
+                                mt.naive_metrics, mt.rankCheckinProfile)
+        self.assertEqual(hit[0], ['c'])
+
+    def test_concurrent_build(self):
+        """ test_concurrent_build serving the old lists during a rebuild """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'index.db')
+            index = ExpertIndex(filename, depth=2)
+            index.buildRegion('Chicago', self.rkbase, mt.INDEX_METRICS,
+                              mt.PROFILE_TYPES)
+            query = self.query({'place.id': 'p1'})
+            expected = index.lookup(query, mt.naive_metrics,
+                                    mt.rankCheckinProfile, cutoff=2)
+            self.assertIsNotNone(expected)
+            writer = sqlite3.connect(filename)
+            writer.execute('BEGIN EXCLUSIVE')
+            writer.execute("DELETE FROM ranking WHERE region = 'Chicago'")
+            self.assertEqual(index.lookup(query, mt.naive_metrics,
+                                          mt.rankCheckinProfile, cutoff=2),
+                             expected)
+            writer.rollback()
+            writer.execute('DROP TABLE ranking')
+            writer.commit()
+            writer.close()
+            self.assertIsNone(index.lookup(query, mt.naive_metrics,
+                                           mt.rankCheckinProfile, cutoff=2))
+            index.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rankExperts(self):
+        """ test_rankExperts answered from the index without check-ins """
+        ger = mt.GeoExpertRetrieval('test', None, index=self.index)
+        ranking = ger.rankExperts(self.query({'place.id': 'p1'}),
+                                  mt.naive_metrics, mt.rankCheckinProfile,
+                                  cutoff=1)
+        self.assertEqual(ranking['candidate'].tolist(), ['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: test_geo.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: http://github.com/spacelis
+Description:
+    Testing the region assignment
+"""
+# pylint: disable=too-many-public-methods
+import unittest
+import numpy as np
+
+import expertise.geo as geo
+import expertise.ger as mt
+
+
+class TestRegionIndex(unittest.TestCase):
+
+    """ Test assigning coordinates to regions"""
+
+    def test_bbox(self):
+        """ test_bbox with the default regions
+        """
+        names = mt.assign_regions([41.8781, 40.7128, 34.0522, 0.],
+                                  [-87.6298, -74.0060, -118.2437, 0.])
+        self.assertEqual(names.tolist(),
+                         ['Chicago', 'New York', 'Los Angeles', None])
+        self.assertEqual(mt.get_region(37.7749, -122.4194), 'San Francisco')
+        self.assertIs(mt.region_index(), mt.region_index())
+
+    def test_polygon(self):
+        """ test_polygon with a hole and a second polygon
+        """
+        square = [[(0., 0.), (4., 0.), (4., 4.), (0., 4.), (0., 0.)],
+                  [(1., 1.), (2., 1.), (2., 2.), (1., 2.), (1., 1.)]]
+        triangle = [[(10., 0.), (12., 0.), (10., 2.), (10., 0.)]]
+        regions = {
+            'A': mt.make_region('A', {'type': 'MultiPolygon',
+                                      'coordinates': [square, triangle]})}
+        lats = np.array([3., 1.5, 0.5, 1.5, 5.])
+        lons = np.array([3., 1.5, 10.5, 11.5, 3.])
+        self.assertEqual(mt.assign_regions(lats, lons, regions).tolist(),
+                         ['A', None, 'A', None, None])
+
+    def test_overlap(self):
+        """ test_overlap taking the first region
+        """
+        index = geo.RegionIndex(['x', 'y'],
+                                [(0., 2., 0., 2.), (1., 3., 1., 3.)],
+                                cell=0.5)
+        self.assertEqual(index.assign([0.5, 1.5, 2.5], [0.5, 1.5, 2.5])
+                         .tolist(), [0, 0, 1])
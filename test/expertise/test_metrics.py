@@ -8,9 +8,16 @@ Github: none
 Description:
 """
 
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+import numpy as np
 import pandas as pd
 import pymongo as mg
 import expertise.ger as mt
+from expertise.visits import VisitAggregate
+from expertise.visits import VisitProfile
 import unittest
 
 
@@ -87,5 +94,347 @@ class TestClass(unittest.TestCase):  # pylint: disable=too-many-public-methods
         print pd.DataFrame(score, index=rank, columns=['score'])
         self.assertTrue(False)
 
+
+class TestColumnarMetrics(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    """ Testing the metrics on a small synthetic set of check-ins."""
+
+    def setUp(self):
+        self.checkins = pd.DataFrame.from_records([
+            {'id': 1, 'user': 'a', 'pid': 'p1', 'created_at': '2013-07-01'},
+            {'id': 2, 'user': 'a', 'pid': 'p1', 'created_at': '2013-07-01'},
+            {'id': 3, 'user': 'a', 'pid': 'p2', 'created_at': '2013-07-02'},
+            {'id': 4, 'user': 'b', 'pid': 'p1', 'created_at': '2013-07-03'},
+            {'id': 5, 'user': 'b', 'pid': 'p1', 'created_at': '2013-07-04'},
+            {'id': 6, 'user': 'b', 'pid': 'p1', 'created_at': '2013-07-05'},
+            {'id': 7, 'user': 'c', 'pid': 'p3', 'created_at': '2013-07-06'},
+        ])
+        self.checkins['created_at'] = pd.to_datetime(
+            self.checkins['created_at'])
+        self.checkins['created_date'] = self.checkins['created_at']
+
+    def test_naive(self):
+        """ test_naive on both profile types sharing one aggregate
+        """
+        aggregate = VisitAggregate(self.checkins)
+        rank, score = mt.rankCheckinProfile(aggregate, mt.naive_metrics)
+        self.assertEqual(list(rank), ['a', 'b', 'c'])
+        self.assertEqual(score.tolist(), [3, 3, 1])
+        rank, score = mt.rankActiveDayProfile(aggregate, mt.naive_metrics)
+        self.assertEqual(list(rank), ['b', 'a', 'c'])
+        self.assertEqual(score.tolist(), [3, 2, 1])
+
+    def test_topk(self):
+        """ test_topk breaking ties by positions
+        """
+        scores = np.array([1., 3., 2., 3., 0., 2.])
+        self.assertEqual(mt._topk(scores, 3).tolist(), [1, 3, 2])
+        self.assertEqual(mt._topk(scores, 2).tolist(), [1, 3])
+        self.assertEqual(mt._topk(scores, -1).tolist(), [1, 3, 2, 5, 0, 4])
+        self.assertEqual(mt._topk(scores, 10).tolist(), [1, 3, 2, 5, 0, 4])
+
+    def test_activeday_readonly(self):
+        """ test_activeday_readonly not touching the check-ins
+        """
+        checkins = self.checkins.copy()
+        checkins['created_at'] = checkins['created_at'] + \
+            pd.Series(np.arange(7) * 3600 * 10 ** 9, dtype='timedelta64[ns]')
+        del checkins['created_date']
+        shuffled = checkins.reindex([6, 2, 4, 0, 5, 1, 3])
+        expected = shuffled.copy()
+        rank, score = mt.rankActiveDayProfile(shuffled, mt.naive_metrics)
+        self.assertEqual(list(rank), ['b', 'a', 'c'])
+        self.assertEqual(score.tolist(), [3, 2, 1])
+        self.assertTrue(shuffled.equals(expected))
+        mt._add_created_date(checkins)
+        self.assertEqual(checkins['created_date'].tolist(),
+                         self.checkins['created_date'].tolist())
+
+    def test_random(self):
+        """ test_random returning cutoff distinct users
+        """
+        rank, score = mt.rankCheckinProfile(self.checkins, mt.random_metrics,
+                                            cutoff=2)
+        self.assertEqual(len(rank), 2)
+        self.assertEqual(len(score), 2)
+        self.assertTrue(set(rank) < set(['a', 'b', 'c']))
+        rank, _ = mt.rankCheckinProfile(self.checkins, mt.random_metrics)
+        self.assertEqual(sorted(rank), ['a', 'b', 'c'])
+
+    def test_diversity(self):
+        """ test_diversity
+        """
+        rank, score = mt.rankCheckinProfile(self.checkins,
+                                            mt.diversity_metrics)
+        self.assertEqual(list(rank), ['a', 'b', 'c'])
+        np.testing.assert_allclose(score, [np.log2(3) + 1, 2, 1])
+
+    def test_RD(self):
+        """ test_RD
+        """
+        refdate = np.datetime64('2013-07-06T00:00:00Z')
+        rank, score = mt.rankCheckinProfile(self.checkins, mt.RD_metrics,
+                                            refdate=refdate, decay_rate=0.)
+        self.assertEqual(list(rank), ['a', 'b', 'c'])
+        np.testing.assert_allclose(score, [np.log2(3) + 1, 2, 1])
+
+    def test_decayed_scorer(self):
+        """ test_decayed_scorer against recomputing the scores
+        """
+        refdate = np.datetime64('2013-07-03T00:00:00Z')
+        newdate = np.datetime64('2013-07-10T00:00:00Z')
+        scorer = mt.DecayedScorer(refdate, decay_rate=0.1)
+        scorer.add(self.checkins[:4])
+        scorer.advance(newdate)
+        scorer.add(self.checkins[4:])
+        for metrics, incremental in [(mt.recency_metrics, scorer.recency),
+                                     (mt.RD_metrics, scorer.RD)]:
+            rank, score = mt.rankCheckinProfile(self.checkins, metrics,
+                                                refdate=newdate,
+                                                decay_rate=0.1)
+            irank, iscore = incremental()
+            self.assertEqual(list(rank), list(irank))
+            np.testing.assert_allclose(score, iscore)
+        self.assertRaises(ValueError, scorer.advance, refdate)
+
+    def test_sweep(self):
+        """ test_sweep against the metrics with each setting
+        """
+        decay_rates = [0., 0.1, 0.5]
+        refdates = [np.datetime64('2013-07-03T00:00:00Z'),
+                    np.datetime64('2013-07-10T00:00:00Z')]
+        aggregate = VisitAggregate(self.checkins)
+        rankings = mt.sweep_metrics(aggregate.activeday, decay_rates,
+                                    refdates, cutoff=2)
+        self.assertEqual(len(rankings), 2 * 3 * 2)
+        rankings = iter(rankings)
+        for metrics in [mt.recency_metrics, mt.RD_metrics]:
+            for decay_rate in decay_rates:
+                for refdate in refdates:
+                    name, srank, sscore = next(rankings)
+                    self.assertEqual(
+                        name, mt.sweep_name(metrics, decay_rate, refdate))
+                    rank, score = mt.rankActiveDayProfile(
+                        aggregate, metrics, cutoff=2, refdate=refdate,
+                        decay_rate=decay_rate)
+                    self.assertEqual(list(rank), list(srank))
+                    np.testing.assert_allclose(score, sscore)
+
+    def test_sweep_extreme(self):
+        """ test_sweep_extreme with a large decay rate and a refdate far from
+            the latest visit against DecayedScorer
+        """
+        checkins = pd.DataFrame.from_records([
+            {'id': 1, 'user': 'a', 'pid': 'p1', 'created_at': '2010-01-01'},
+            {'id': 2, 'user': 'b', 'pid': 'p1', 'created_at': '2013-07-01'},
+            {'id': 3, 'user': 'c', 'pid': 'p2', 'created_at': '2013-07-06'},
+        ])
+        checkins['created_at'] = pd.to_datetime(checkins['created_at'])
+        checkins['created_date'] = checkins['created_at']
+        decay_rates = [1.]
+        refdates = [np.datetime64('2011-10-01T00:00:00Z'),
+                    np.datetime64('2013-07-10T00:00:00Z')]
+        rankings = iter(mt.sweep_metrics(VisitAggregate(checkins).checkin,
+                                         decay_rates, refdates))
+        for metrics in ['recency', 'RD']:
+            for refdate in refdates:
+                _, srank, sscore = next(rankings)
+                scorer = mt.DecayedScorer(refdate, decay_rate=1.)
+                scorer.add(checkins)
+                rank, score = getattr(scorer, metrics)()
+                self.assertEqual(list(rank), list(srank))
+                self.assertTrue(np.all(np.isfinite(sscore)))
+                np.testing.assert_allclose(score, sscore)
+
+    def test_compact(self):
+        """ test_compact ranking the same as the plain check-ins
+        """
+        dictionaries = dict()
+        kbase = mt.KnowledgeBase(self.checkins.copy()).compact(dictionaries)
+        self.assertEqual(dictionaries['user'].tolist(), ['a', 'b', 'c'])
+        topic = kbase.select({'place.id': 'p1'})
+        for pf_type in mt.PROFILE_TYPES:
+            for metrics in [mt.naive_metrics, mt.diversity_metrics]:
+                rank, score = topic.rank(pf_type, metrics, cutoff=-1)
+                erank, escore = pf_type(
+                    self.checkins[self.checkins['pid'] == 'p1'], metrics)
+                self.assertEqual(list(rank), list(erank))
+                np.testing.assert_allclose(score, escore)
+
+    def test_aggregate_from_chunks(self):
+        """ test_aggregate_from_chunks against the aggregate of all check-ins
+        """
+        chunks = [self.checkins[3:], self.checkins[:3]]
+        aggregate = VisitAggregate.fromChunks(chunks)
+        for pf_type in mt.PROFILE_TYPES:
+            for metrics in [mt.naive_metrics, mt.diversity_metrics]:
+                rank, score = pf_type(aggregate, metrics)
+                erank, escore = pf_type(self.checkins, metrics)
+                self.assertEqual(list(rank), list(erank))
+                np.testing.assert_allclose(score, escore)
+
+    def test_pairs(self):
+        """ test_pairs ranking pre-counted visits as the check-ins
+        """
+        profile = VisitProfile.fromPairs(['b', 'a', 'a', 'c'],
+                                         ['p1', 'p1', 'p2', 'p3'],
+                                         [3, 2, 1, 1])
+        for metrics in mt.PUSHDOWN_METRICS[:2] + mt.PUSHDOWN_METRICS[3:]:
+            rank, score = metrics(profile)
+            erank, escore = mt.rankCheckinProfile(self.checkins, metrics)
+            self.assertEqual(list(rank), list(erank))
+            np.testing.assert_allclose(score, escore)
+        self.assertRaises(ValueError, mt.recency_metrics, profile)
+
+    def test_fromTSV(self):
+        """ test_fromTSV producing a rankable KnowledgeBase
+        """
+        tsv = StringIO('\n'.join(
+            '%s\tcate\t%s 12:00:00\t%s' % (u, t.strftime('%Y-%m-%d'), p)
+            for u, t, p in self.checkins[['user', 'created_at', 'pid']]
+            .values))
+        kbase = mt.KnowledgeBase.fromTSV(tsv, chunksize=3)
+        self.assertEqual(kbase.checkins['id'].tolist(), range(7))
+        for pf_type in mt.PROFILE_TYPES:
+            rank, score = kbase.rank(pf_type, mt.diversity_metrics, cutoff=-1)
+            erank, escore = pf_type(self.checkins, mt.diversity_metrics)
+            self.assertEqual(list(rank), list(erank))
+            np.testing.assert_allclose(score, escore)
+
+    def test_select(self):
+        """ test_select topics from a loaded KnowledgeBase
+        """
+        kbase = mt.KnowledgeBase(self.checkins)
+        self.assertEqual(len(kbase.select({'place.id': 'p1'}).checkins), 5)
+        self.assertEqual(len(kbase.select(
+            {'place.id': {'$in': ['p2', 'p3']}}).checkins), 2)
+        self.assertRaises(ValueError, kbase.select, {'place.id': 'p4'})
+
+    def test_query2filters(self):
+        """ test_query2filters translating Mongo queries for pyarrow
+        """
+        projection = mt.KnowledgeBase.DEFAULT_PROJECTION
+        filters = mt._query2filters({mt.CKLAT: {'$gte': 41.0, '$lt': 42.0},
+                                     'place.id': 'p1'}, projection)
+        self.assertEqual(sorted(filters), [('lat', '<', 42.0),
+                                           ('lat', '>=', 41.0),
+                                           ('pid', '=', 'p1')])
+        self.assertEqual(mt._query2filters(
+            {'place.id': {'$in': ['p2', 'p3']}}, projection),
+            [('pid', 'in', ['p2', 'p3'])])
+        self.assertEqual(mt._query2filters(dict(), projection), [])
+        self.assertRaises(ValueError, mt._query2filters,
+                          {'place.nowhere': 'p1'}, projection)
+        self.assertRaises(ValueError, mt._query2filters,
+                          {'place.id': {'$regex': 'p'}}, projection)
+
+    def test_parquet(self):
+        """ test_parquet selecting the same check-ins as from memory
+        """
+        checkins = self.checkins.copy()
+        checkins['lat'] = [41.5, 41.5, 40.5, 41.5, 41.5, 41.5, 41.8]
+        checkins['lng'] = [-87.5, -87.5, -73.9, -87.5, -87.5, -87.5, -87.6]
+        del checkins['created_date']
+        mt._add_created_date(checkins)
+        query = {mt.CKLAT: {'$gte': 41.0, '$lte': 42.0},
+                 mt.CKLON: {'$gte': -88.0, '$lte': -87.0},
+                 'place.id': {'$in': ['p1', 'p2']}}
+        tmpdir = tempfile.mkdtemp()
+        try:
+            snapshot = os.path.join(tmpdir, 'checkins.parquet')
+            mt.KnowledgeBase(checkins).toParquet(snapshot, row_group_size=2)
+            loaded = mt.KnowledgeBase.fromParquet(snapshot, query).checkins
+            # Every row group is skipped by the min and max of pid
+            self.assertRaises(ValueError, mt.KnowledgeBase.fromParquet,
+                              snapshot, {'place.id': 'p9'})
+        finally:
+            shutil.rmtree(tmpdir)
+        expected = mt.KnowledgeBase(checkins).select(query).checkins
+        self.assertEqual(sorted(loaded['id']), [1, 2, 4, 5, 6])
+        self.assertEqual(sorted(loaded['id']), sorted(expected['id']))
+        loaded = loaded.set_index('id').sort_index()
+        expected = expected.set_index('id').sort_index()
+        for col in ['user', 'pid', 'lat', 'lng', 'created_at']:
+            self.assertEqual(loaded[col].tolist(), expected[col].tolist())
+
+    def test_bao2012(self):
+        """ test_bao2012 against the dense power iteration
+        """
+        rank, score = mt.rankCheckinProfile(self.checkins,
+                                            mt.bao2012_metrics)
+        M = np.array([[2., 1., 0.], [3., 0., 0.], [0., 0., 1.]])
+        P = np.dot(M, M.T)
+        A = mt.converge(lambda x: np.dot(P, x), M.sum(axis=1), rtol=0.001)
+        expected = pd.Series(A, index=['a', 'b', 'c'])
+        np.testing.assert_allclose(score, expected[rank].values)
+
+    def test_prefetch(self):
+        """ test_prefetch ranking the same as loading in turn
+        """
+        kbase = mt.KnowledgeBase(self.checkins)
+        ger = mt.GeoExpertRetrieval('test', None)
+        ger.fetchRegion = lambda region: kbase
+        topics = pd.DataFrame({'topic_id': ['p-1', 'p-2', 'p-3', 'p-4'],
+                               'topic': ['p1', 'p2', 'p4', 'p3'],
+                               'associate_id': ['p1', 'p2', 'p4', 'p3'],
+                               'region': ['Chicago', 'Chicago',
+                                          'New York', 'New York']})
+        metrics = [mt.naive_metrics, mt.RD_metrics]
+        expected = ger.batchQuery(topics, metrics, mt.PROFILE_TYPES)
+        for prefetch in [1, 3]:
+            rankings = ger.batchQuery(topics, metrics, mt.PROFILE_TYPES,
+                                      prefetch=prefetch)
+            self.assertEqual(rankings['topic_id'].tolist(),
+                             expected['topic_id'].tolist())
+            self.assertEqual(rankings['candidate'].tolist(),
+                             expected['candidate'].tolist())
+        self.assertEqual(sorted(set(expected['topic_id'])),
+                         ['p-1', 'p-2', 'p-4'])
+
+    def test_workers(self):
+        """ test_workers ranking the same as a single process
+        """
+        kbase = mt.KnowledgeBase(self.checkins)
+        ger = mt.GeoExpertRetrieval('test', None)
+        ger.fetchRegion = lambda region: kbase
+        topics = pd.DataFrame({'topic_id': ['p-1', 'p-2', 'p-4', 'p-3'],
+                               'topic': ['p1', 'p2', 'p4', 'p3'],
+                               'associate_id': ['p1', 'p2', 'p4', 'p3'],
+                               'region': ['Chicago', 'Chicago',
+                                          'New York', 'New York']})
+        metrics = [mt.naive_metrics, mt.RD_metrics]
+        expected = ger.batchQuery(topics, metrics, mt.PROFILE_TYPES)
+        rankings = ger.batchQuery(topics, metrics, mt.PROFILE_TYPES,
+                                  workers=2)
+        self.assertEqual(sorted(set(rankings['topic_id'])),
+                         ['p-1', 'p-2', 'p-3'])
+        for col in ['topic_id', 'rank_method', 'profile_type', 'rank',
+                    'candidate']:
+            self.assertEqual(rankings[col].tolist(), expected[col].tolist())
+        np.testing.assert_allclose(rankings['score'].values,
+                                   expected['score'].values)
+
+    def test_writer(self):
+        """ test_writer streaming rankings with one header
+        """
+        ger = mt.GeoExpertRetrieval('test', None)
+        kbase = mt.KnowledgeBase(self.checkins)
+        query = ger.formatQuery('p-1', 'p1', 'p1', 'Chicago', {}, 'p')
+        rankings = [ger.rankKnowledgeBase(kbase.select({'place.id': 'p1'}),
+                                          query, mtc, mt.rankCheckinProfile)
+                    for mtc in [mt.naive_metrics, mt.diversity_metrics]]
+        sink = StringIO()
+        writer = mt.RankingWriter(sink)
+        writer.writeAll(rankings)
+        writer.close()
+        self.assertEqual(writer.rows, 4)
+        sink.seek(0)
+        written = pd.read_csv(sink)
+        self.assertEqual(written.columns.tolist(), ger.RANK_SCHEMA)
+        self.assertEqual(written['candidate'].tolist(), ['b', 'a'] * 2)
+        self.assertEqual(written['rank_method'].tolist(),
+                         ['naive_metrics'] * 2 + ['diversity_metrics'] * 2)
+
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: test_pandasmongo.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: http://github.com/spacelis
+Description:
+    Testing making DataFrames from documents
+"""
+# pylint: disable=too-many-public-methods
+import unittest
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+import expertise.pandasmongo as pm
+
+
+class FakeCursor(list):
+
+    """ A list of documents acting as a cursor"""
+
+    def batch_size(self, _):
+        """ batch_size """
+        return self
+
+
+class FakeCollection(object):
+
+    """ A collection of documents recording the queries"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.fields = None
+
+    def find(self, query, fields=None):
+        """ find """
+        self.fields = fields
+        return FakeCursor(self.docs)
+
+
+class TestGetDataFrame(unittest.TestCase):
+
+    """ Test getDataFrame"""
+
+    def setUp(self):
+        self.docs = [{'id': i,
+                      'user': {'screen_name': 'u%d' % (i % 3)},
+                      'place': {'id': 'p%d' % (i % 2),
+                                'bounding_box': {
+                                    'coordinates': [[[-74. + i, 40.]]]}}}
+                     for i in range(10)]
+        self.projection = {'id': 'id',
+                           'user.screen_name': 'user',
+                           'place.id': 'pid',
+                           'place.bounding_box.coordinates.0.0.0': 'lng'}
+
+    def test_extractor(self):
+        """ test_extractor with shared prefixes and missing fields """
+        extractor = pm.ProjectionExtractor(
+            ['place.id', 'place.category.name',
+             'place.bounding_box.coordinates.0.0.0', 'id'],
+            defaults={'place.category.name': 'N/A'})
+        self.assertEqual(extractor.extract(self.docs[1]),
+                         ['p1', 'N/A', -73., 1])
+        self.assertEqual(extractor.extract({'place': None}),
+                         [None, 'N/A', None, None])
+        self.assertEqual(extractor.extract({'id': 2}),
+                         [None, 'N/A', None, 2])
+        # The lookups under place are only run once place is found
+        lines = extractor.source.splitlines()
+        place = [l for l in lines if "x['place']" in l][0]
+        category = [l for l in lines if "['category']" in l][0]
+        self.assertGreater(len(category) - len(category.lstrip()),
+                           len(place) - len(place.lstrip()))
+        for doc in self.docs:
+            self.assertEqual(
+                extractor.extract(doc)[2],
+                pm.DotPathEvaluator(
+                    'place.bounding_box.coordinates.0.0.0').extract(doc))
+
+    def test_server_projection(self):
+        """ test_server_projection """
+        self.assertEqual(
+            pm.server_projection(['place.id', 'place', 'a.0.1', 'a.b']),
+            {'place': 1, 'a': 1, '_id': 0})
+
+    def test_getDataFrame(self):
+        """ test_getDataFrame """
+        coll = FakeCollection(self.docs)
+        df = pm.getDataFrame(coll, {}, self.projection, batch_size=5,
+                             dtypes={'id': 'int64', 'lng': 'float64'})
+        self.assertEqual(coll.fields, {'id': 1, 'user.screen_name': 1,
+                                       'place.id': 1,
+                                       'place.bounding_box.coordinates': 1,
+                                       '_id': 0})
+        self.assertEqual(df['id'].tolist(), range(10))
+        self.assertEqual(df['user'].tolist()[:4], ['u0', 'u1', 'u2', 'u0'])
+        self.assertEqual(df['lng'].dtype.name, 'float64')
+        self.assertRaises(ValueError, pm.getDataFrame,
+                          FakeCollection([]), {}, self.projection)
+
+    def test_iterDataFrame(self):
+        """ test_iterDataFrame """
+        chunks = list(pm.iterDataFrame(FakeCollection(self.docs), {},
+                                       self.projection, chunksize=4))
+        self.assertEqual([len(c) for c in chunks], [4, 4, 2])
+        self.assertEqual(chunks[2]['pid'].tolist(), ['p0', 'p1'])
+
+    def test_splitRange(self):
+        """ test_splitRange """
+        self.assertEqual(pm._splitRange(0, 10, 4), [0, 2.5, 5., 7.5, 10])
+        self.assertEqual(
+            pm._splitRange(datetime(2013, 1, 1), datetime(2013, 1, 3), 2),
+            [datetime(2013, 1, 1), datetime(2013, 1, 2),
+             datetime(2013, 1, 3)])
+        lo = ObjectId.from_datetime(datetime(2013, 1, 1))
+        hi = ObjectId.from_datetime(datetime(2013, 1, 3))
+        bounds = pm._splitRange(lo, hi, 2)
+        self.assertEqual(bounds[1].generation_time.day, 2)
+        self.assertEqual(sorted(bounds), bounds)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: test_profiling.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: http://github.com/spacelis
+Description:
+    Testing the instrumentation of the stages of ranking
+"""
+# pylint: disable=too-many-public-methods
+import json
+import unittest
+from StringIO import StringIO
+import pandas as pd
+
+import expertise.ger as mt
+from expertise import profiling
+
+
+class TestProfiling(unittest.TestCase):
+
+    """ Test recording the stages of a batch of topics"""
+
+    def setUp(self):
+        checkins = pd.DataFrame.from_records([
+            {'user': 'a', 'pid': 'p1', 'created_at': '2013-07-01'},
+            {'user': 'a', 'pid': 'p2', 'created_at': '2013-07-02'},
+            {'user': 'b', 'pid': 'p1', 'created_at': '2013-07-03'},
+        ])
+        checkins['created_at'] = pd.to_datetime(checkins['created_at'])
+        mt._add_created_date(checkins)
+        kbase = mt.KnowledgeBase(checkins)
+        self.ger = mt.GeoExpertRetrieval('test', None)
+        self.ger.fetchRegion = lambda region: kbase
+        self.topics = pd.DataFrame({'topic_id': ['p-1', 'p-2'],
+                                    'topic': ['p1', 'p2'],
+                                    'associate_id': ['p1', 'p2'],
+                                    'region': ['Chicago', 'Chicago']})
+        self.sink = StringIO()
+        self.profiler = profiling.Profiler(self.sink)
+        profiling.enable(self.profiler)
+
+    def tearDown(self):
+        profiling.disable()
+
+    def test_stages(self):
+        """ test_stages recorded per topic and metric """
+        self.ger.batchQuery(self.topics, [mt.naive_metrics],
+                            mt.PROFILE_TYPES)
+        records = [json.loads(l) for l in self.sink.getvalue().splitlines()]
+        self.assertEqual(len(records), len(self.profiler.records))
+        stages = set(r['stage'] for r in records)
+        for stage in ['topic', 'select', 'aggregate', 'profile', 'metric',
+                      'format']:
+            self.assertIn(stage, stages)
+        metrics = [r for r in records if r['stage'] == 'metric']
+        self.assertEqual(sorted((r['topic_id'], r['profile_type'])
+                                for r in metrics),
+                         [('p-1', 'rankActiveDayProfile'),
+                          ('p-1', 'rankCheckinProfile'),
+                          ('p-2', 'rankActiveDayProfile'),
+                          ('p-2', 'rankCheckinProfile')])
+        self.assertTrue(all(r['metric'] == 'naive_metrics' for r in metrics))
+        selects = [r['rows'] for r in records if r['stage'] == 'select']
+        self.assertEqual(selects, [2, 1])
+        summary = self.profiler.summary()
+        self.assertEqual(summary.loc['topic', 'count'], 2)
+        self.assertEqual(sorted(self.profiler.slowest().index), ['p-1', 'p-2'])
+        self.assertIn('Slowest topics', self.profiler.report())
+
+    def test_disabled(self):
+        """ test_disabled recording nothing """
+        profiling.disable()
+        with profiling.stage('select') as info:
+            info['rows'] = 1
+        self.assertEqual(self.profiler.records, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
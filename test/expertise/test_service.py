@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: test_service.py
+Author: SpaceLis
+Email: Wen.Li@tudelft.nl
+Github: http://github.com/spacelis
+Description:
+    Testing the query service
+"""
+# pylint: disable=too-many-public-methods
+import json
+import threading
+import unittest
+import urllib2
+from multiprocessing import TimeoutError
+import pandas as pd
+
+import expertise.ger as mt
+from expertise.service import ExpertServer
+from expertise.service import ExpertService
+from expertise.service import ServiceBusy
+from expertise.service import LatencyRecorder
+
+
+class FakeRetrieval(object):
+
+    """ Returning the same check-ins for every region """
+
+    def __init__(self, kbase):
+        self.kbase = kbase
+        self.index = None
+        self.loads = 0
+
+    def fetchRegion(self, _):
+        """ Count the loads """
+        self.loads += 1
+        return self.kbase
+
+
+class TestExpertService(unittest.TestCase):
+
+    """ Test ranking with the regions kept in memory"""
+
+    def setUp(self):
+        checkins = pd.DataFrame.from_records([
+            {'user': 'a', 'pid': 'p1', 'created_at': '2013-07-01'},
+            {'user': 'b', 'pid': 'p1', 'created_at': '2013-07-03'},
+            {'user': 'b', 'pid': 'p1', 'created_at': '2013-07-04'},
+            {'user': 'c', 'pid': 'p2', 'created_at': '2013-07-06'},
+        ])
+        checkins['created_at'] = pd.to_datetime(checkins['created_at'])
+        mt._add_created_date(checkins)
+        self.retrieval = FakeRetrieval(mt.KnowledgeBase(checkins))
+        self.service = ExpertService(self.retrieval, timeout=5.)
+
+    def tearDown(self):
+        self.service.close()
+
+    def test_rank(self):
+        """ test_rank loading the region once """
+        params = {'region': 'Chicago', 'topic_type': 'p',
+                  'associate_id': 'p1', 'cutoff': '1'}
+        for _ in range(2):
+            ranking = self.service.rank(params)
+            self.assertEqual([r['candidate'] for r in ranking], ['b'])
+            self.assertEqual(ranking[0]['rank_method'], 'naive_metrics')
+        self.assertEqual(self.retrieval.loads, 1)
+
+    def test_bad_request(self):
+        """ test_bad_request raising ValueError """
+        self.assertRaises(ValueError, self.service.rank,
+                          {'region': 'Nowhere', 'topic_type': 'p',
+                           'associate_id': 'p1'})
+        self.assertRaises(ValueError, self.service.rank,
+                          {'region': 'Chicago', 'topic_type': 'p',
+                           'associate_id': 'p1', 'metric': 'unknown'})
+
+    def test_busy(self):
+        """ test_busy rejecting while a timed-out ranking holds the slot """
+        loaded = threading.Event()
+        fetch = self.retrieval.fetchRegion
+
+        def slow_fetch(region):
+            """ Wait for the test to release the loading """
+            loaded.wait()
+            return fetch(region)
+
+        self.retrieval.fetchRegion = slow_fetch
+        service = ExpertService(self.retrieval, timeout=.1, threads=1,
+                                backlog=0)
+        params = {'region': 'Chicago', 'topic_type': 'p',
+                  'associate_id': 'p1', 'cutoff': '1'}
+        try:
+            self.assertRaises(TimeoutError, service.rank, params)
+            self.assertRaises(ServiceBusy, service.rank, params)
+            loaded.set()
+            service._pool.apply(lambda: None)  # Waiting for the slot to free
+            self.assertEqual([r['candidate'] for r in service.rank(params)],
+                             ['b'])
+        finally:
+            loaded.set()
+            service.close()
+
+    def test_server_error(self):
+        """ test_server_error replying 500 to unexpected failures """
+        def broken_fetch(_):
+            """ Fail as the store of check-ins would """
+            raise RuntimeError('The check-ins are gone.')
+
+        self.retrieval.fetchRegion = broken_fetch
+        server = ExpertServer(('127.0.0.1', 0), self.service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/rank?region=Chicago&topic_type=p' \
+                '&associate_id=p1' % server.server_address[1]
+            with self.assertRaises(urllib2.HTTPError) as err:
+                urllib2.urlopen(url)
+            self.assertEqual(err.exception.code, 500)
+            self.assertIn('error', json.loads(err.exception.read()))
+            self.assertEqual(self.service.latency.stats()['error'], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_latency(self):
+        """ test_latency percentiles """
+        recorder = LatencyRecorder()
+        self.assertIsNone(recorder.stats()['p50_ms'])
+        for i in range(1, 101):
+            recorder.record(i / 1000.)
+        recorder.record(1., 'timeout')
+        stats = recorder.stats()
+        self.assertEqual(stats['ok'], 100)
+        self.assertEqual(stats['timeout'], 1)
+        self.assertAlmostEqual(stats['p50_ms'], 51.)
+
+
+if __name__ == '__main__':
+    unittest.main()